@@ -1,11 +1,14 @@
 import argparse
+import contextlib
 import glob
+import hashlib
 import logging
 import os
 import pickle
 import random
 import re
 import shutil
+import time
 from typing import Dict, List, Tuple
 from copy import deepcopy
 from multiprocessing import Pool
@@ -13,9 +16,12 @@ from multiprocessing import Pool
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import (
+    DataLoader, Dataset, IterableDataset, RandomSampler, Sampler, SequentialSampler, get_worker_info
+)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
+from token_store import TokenStore, is_token_store, iter_text_file, write_token_store
 
 from transformers import (
     WEIGHTS_NAME,
@@ -58,6 +64,12 @@ MODEL_CLASSES = {
     "camembert": (CamembertConfig, CamembertForMaskedLM, CamembertTokenizer),
 }
 
+# Bump when the cached dataset layout changes, so stale caches are rebuilt instead of misread
+CACHE_VERSION = 1
+
+# Caches rebuilt by this process, so --overwrite_cache rebuilds each cache once and not on every evaluation
+_rebuilt_caches = set()
+
 MASK_LIST = {
     "3": [-1, 1],
     "4": [-1, 1, 2],
@@ -65,25 +77,264 @@ MASK_LIST = {
     "6": [-2, -1, 1, 2, 3]
 }
 
-class LineByLineTextDataset(Dataset):
-    def __init__(self, tokenizer: PreTrainedTokenizer, file_path: str, block_size=512):
+class PreTokenizedDataset(Dataset):
+    """ Sequences of a token store (see token_store.py), memory-mapped instead of loaded into Python lists.
 
-        with open(file_path,'r' ,encoding="utf-8") as f:
+    Every DataLoader worker and DDP rank shares the same page cache, and __getitem__ returns a zero-copy
+    tensor over the mapped tokens (int16 or int32, widened to long after padding in collate). """
 
-            lines = f.read().splitlines()[:-1]
-            self.examples = [list(map(int, item.split())) for item in lines]
+    def __init__(self, file_path: str, block_size=512):
+        self.store = TokenStore(file_path)
+        self.block_size = block_size
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.store)
 
     def __getitem__(self, i):
-        return torch.tensor(self.examples[i], dtype=torch.long)
+        return torch.from_numpy(self.store[i][:self.block_size])
+
+    def lengths(self):
+        return np.minimum(self.store.lengths(), self.block_size)
+
+
+class StreamingTokenDataset(IterableDataset):
+    """ Shuffled stream over a token store for corpora larger than host memory (--streaming).
+
+    Every epoch the sequences are cut into contiguous chunks whose order is permuted with (seed, epoch). The
+    chunks are dealt round-robin to world_size * num_workers shards, one per DDP rank and DataLoader worker,
+    and each shard reads its chunks front to back through a shuffle buffer of sequence indices. All shards
+    stop after the same number of sequences, so every rank runs the same number of steps.
+
+    The stream yields (examples, state) batches, state being the shard position after the batch. Feeding the
+    states of the consumed batches back through load_state_dict resumes the epoch exactly where it stopped. """
+
+    def __init__(self, file_path: str, block_size=512, batch_size=8, shuffle_buffer_size=10000, seed=42,
+                 rank=0, world_size=1, num_workers=0, chunk_size=1024):
+        self.store = TokenStore(file_path)
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = max(1, shuffle_buffer_size)
+        self.seed = seed
+        self.rank = rank
+        self.num_workers = max(1, num_workers)
+        self.num_shards = world_size * self.num_workers
+        # Keep at least a few chunks per shard on small stores
+        self.chunk_size = max(1, min(chunk_size, len(self.store) // (8 * self.num_shards)))
+        self.epoch = 0
+        self.resume_states = {}
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.resume_states = {}
+        self.epoch = epoch
+
+    def shard_chunks(self):
+        """ [start, end) sequence ranges of the chunks of every shard in this epoch """
+        starts = np.arange(0, len(self.store), self.chunk_size)
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(len(starts))
+        return [
+            [(starts[c], min(starts[c] + self.chunk_size, len(self.store))) for c in order[shard::self.num_shards]]
+            for shard in range(self.num_shards)
+        ]
+
+    def examples_per_shard(self):
+        return min(sum(end - start for start, end in chunks) for chunks in self.shard_chunks())
+
+    def __len__(self):
+        """ Number of batches per rank in an epoch """
+        return self.num_workers * -(-self.examples_per_shard() // self.batch_size)
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "num_shards": self.num_shards, "shards": dict(self.resume_states)}
+
+    def load_state_dict(self, state):
+        """ Resume from a state whose shards are {shard: the state yielded with the last consumed batch} """
+        if state["num_shards"] != self.num_shards:
+            logger.warning(
+                "Stream state has %d shards but this run uses %d, restarting epoch %d from its beginning",
+                state["num_shards"], self.num_shards, state["epoch"]
+            )
+            self.resume_states = {}
+        else:
+            self.resume_states = dict(state["shards"])
+        self.epoch = state["epoch"]
+
+    def record(self, state):
+        """ Remember the position of a consumed batch, for state_dict """
+        self.resume_states[state["shard"]] = state
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        if num_workers != self.num_workers:
+            raise ValueError(f"StreamingTokenDataset built for {self.num_workers} workers, run with {num_workers}")
+        shard = self.rank * self.num_workers + worker_id
+
+        chunks = self.shard_chunks()[shard]
+        limit = self.examples_per_shard()
+        chunk_ends = np.cumsum([end - start for start, end in chunks])
+        state = self.resume_states.get(shard)
+        if state is not None:
+            rng = np.random.default_rng()
+            rng.bit_generator.state = state["rng"]
+            position, yielded, buffer = state["position"], state["yielded"], list(state["buffer"])
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch, shard])
+            position, yielded, buffer = 0, 0, []
+
+        examples = []
+        while yielded < limit:
+            # Fill the buffer from the shard's index stream, then draw a random buffered sequence
+            while len(buffer) < self.shuffle_buffer_size and position < chunk_ends[-1]:
+                c = int(np.searchsorted(chunk_ends, position, side='right'))
+                start, end = chunks[c]
+                offset = end - (chunk_ends[c] - position)
+                count = min(end - offset, self.shuffle_buffer_size - len(buffer))
+                buffer.extend(range(offset, offset + count))
+                position += count
+            j = int(rng.integers(len(buffer)))
+            buffer[j], buffer[-1] = buffer[-1], buffer[j]
+            index = buffer.pop()
+            examples.append(torch.from_numpy(self.store[index][:self.block_size]))
+            yielded += 1
+            if len(examples) == self.batch_size or yielded == limit:
+                yield examples, {
+                    "shard": shard, "position": position, "yielded": yielded,
+                    "buffer": np.asarray(buffer, dtype=np.int64), "rng": rng.bit_generator.state
+                }
+                examples = []
+
+
+class BucketBatchSampler(Sampler):
+    """ Batches of similar-length sequences, to cut the padding added by collate.
+
+    The indices of the base sampler (RandomSampler or DistributedSampler) are taken in groups of
+    batch_size * bucket_size_multiplier, each group is sorted by length and cut into batches, and the batches
+    are shuffled. With max_tokens > 0 a batch instead holds as many sequences as fit in max_tokens padded
+    tokens. Token-budget batch counts differ between ranks, so in distributed training every rank repeats
+    its first batches up to the largest count of any rank. """
+
+    def __init__(self, sampler, lengths, batch_size, bucket_size_multiplier=100, max_tokens=0):
+        self.sampler = sampler
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.group_size = batch_size * bucket_size_multiplier
+        self.max_tokens = max_tokens
+        self.epoch = 0
+        self.next_batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.next_batches = None
+        self.epoch = epoch
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def make_batches(self, indices):
+        batches = []
+        for start in range(0, len(indices), self.group_size):
+            group = np.asarray(indices[start:start + self.group_size])
+            group = group[np.argsort(self.lengths[group], kind='stable')]
+            if self.max_tokens <= 0:
+                batches.extend(group[i:i + self.batch_size].tolist() for i in range(0, len(group), self.batch_size))
+                continue
+            batch = []
+            for index in group.tolist():
+                # The group is sorted, so the new sequence is the longest of the batch
+                if batch and (len(batch) + 1) * self.lengths[index] > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(index)
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def epoch_batches(self):
+        batches = self.make_batches(list(self.sampler))
+        if self.max_tokens > 0 and isinstance(self.sampler, DistributedSampler):
+            num_batches = max(
+                len(self.make_batches(self._replica_indices(rank))) for rank in range(self.sampler.num_replicas)
+            )
+            batches += [batches[i % len(batches)] for i in range(num_batches - len(batches))]
+        return batches
+
+    def _replica_indices(self, rank):
+        """ Indices the DistributedSampler of another rank draws in this epoch """
+        replica = DistributedSampler(
+            self.sampler.dataset, num_replicas=self.sampler.num_replicas, rank=rank,
+            shuffle=self.sampler.shuffle, seed=self.sampler.seed, drop_last=self.sampler.drop_last
+        )
+        replica.set_epoch(self.sampler.epoch)
+        return list(replica)
+
+    def __iter__(self):
+        # Batches drawn by __len__ are kept for the next iteration, so the two agree
+        batches, self.next_batches = self.next_batches or self.epoch_batches(), None
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        if self.max_tokens <= 0:
+            num_samples = len(self.sampler)
+            full_groups, rest = divmod(num_samples, self.group_size)
+            return full_groups * -(-self.group_size // self.batch_size) + -(-rest // self.batch_size)
+        if self.next_batches is None:
+            self.next_batches = self.epoch_batches()
+        return len(self.next_batches)
+
+
+def _file_fingerprint(file_path, sample_bytes=1 << 20):
+    """ Hash of a data file's size, modification time and first and last MiB, cheap even for multi-GB files """
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(f"{stat.st_size}:{stat.st_mtime_ns}".encode(), digest_size=8)
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(sample_bytes))
+        if stat.st_size > sample_bytes:
+            f.seek(max(sample_bytes, stat.st_size - sample_bytes))
+            digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+
+def cached_features_prefix(file_path, block_size):
+    """ Token store caching a text data file, next to it and keyed by cache version, block size and file hash """
+    directory, filename = os.path.split(file_path)
+    return os.path.join(
+        directory, f"cached_lm_v{CACHE_VERSION}_{block_size}_{_file_fingerprint(file_path)}_{filename}"
+    )
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False):
     file_path = args.eval_data_file if evaluate else args.train_data_file
 
-    return LineByLineTextDataset(tokenizer, file_path=file_path, block_size=args.block_size)
+    if not is_token_store(file_path):
+        cached_prefix = cached_features_prefix(file_path, args.block_size)
+        # In distributed training only the first process rebuilds, the others wait at a barrier and reuse its cache
+        overwrite_cache = (
+            args.overwrite_cache and args.local_rank in [-1, 0] and cached_prefix not in _rebuilt_caches
+        )
+        if is_token_store(cached_prefix) and not overwrite_cache:
+            logger.info("Loading features from cached file %s", cached_prefix)
+        else:
+            # Every non-blank line is one sequence. Blank lines carry no tokens to train on and are skipped
+            logger.info("Creating features from dataset file %s", file_path)
+            write_token_store((ids[:args.block_size] for ids in iter_text_file(file_path)), cached_prefix)
+            _rebuilt_caches.add(cached_prefix)
+            logger.info("Saving features into cached file %s", cached_prefix)
+        file_path = cached_prefix
+
+    if args.streaming and not evaluate:
+        return StreamingTokenDataset(
+            file_path,
+            block_size=args.block_size,
+            batch_size=args.per_gpu_train_batch_size * max(1, args.n_gpu),
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            seed=args.seed,
+            num_workers=args.n_process if args.n_process > 1 else 0,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            world_size=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+        )
+    return PreTokenizedDataset(file_path, block_size=args.block_size)
 
 
 def set_seed(args):
@@ -130,21 +381,33 @@ def _rotate_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False) -
         shutil.rmtree(checkpoint)
 
 
-def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> Tuple[torch.Tensor, torch.Tensor]:
-    """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
+def special_tokens_table(tokenizer: PreTrainedTokenizer, device=None) -> torch.Tensor:
+    """ Boolean lookup table over the vocabulary, True at the special token IDs """
+    table = torch.zeros(len(tokenizer), dtype=torch.bool, device=device)
+    table[torch.tensor(tokenizer.all_special_ids, dtype=torch.long, device=device)] = True
+    return table
+
+
+def mask_tokens(
+    inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args, special_tokens: torch.Tensor = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
+
+    special_tokens is the table of special_tokens_table; pass it precomputed (on the device of inputs) to
+    avoid rebuilding it every batch. Every step runs on the device of inputs. """
 
     if tokenizer.mask_token is None:
         raise ValueError(
             "This tokenizer does not have a mask token which is necessary for masked language modeling. Remove the --mlm flag if you want to use this tokenizer."
         )
+    device = inputs.device
+    if special_tokens is None:
+        special_tokens = special_tokens_table(tokenizer, device=device)
 
     labels = inputs.clone()
     # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-    probability_matrix = torch.full(labels.shape, args.mlm_probability)
-    special_tokens_mask = [
-        tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-    ]
-    probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
+    probability_matrix = torch.full(labels.shape, args.mlm_probability, device=device)
+    probability_matrix.masked_fill_(special_tokens[labels], value=0.0)
     #if tokenizer._pad_token is not None:
     if tokenizer.pad_token is not None:
         padding_mask = labels.eq(tokenizer.pad_token_id)
@@ -157,12 +420,12 @@ def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> T
     labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
     # 80% 的时间用掩码 token 替换被掩码的 token
-    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
-    inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=device)).bool() & masked_indices
+    inputs[indices_replaced] = tokenizer.mask_token_id
 
     # 10% 的时间用随机 token 替换被掩码的 token
-    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
+    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5, device=device)).bool() & masked_indices & ~indices_replaced
+    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long, device=device)
     inputs[indices_random] = random_words[indices_random]
 
     attention_mask = (inputs != tokenizer.pad_token_id).long()  # 非填充值的位置为 1，填充值为 0
@@ -171,21 +434,101 @@ def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> T
 
     # 其余的 10% 保持原样
 
+class MLMCollator:
+    """ Pads a batch of sequences and builds the model inputs: input_ids, attention_mask and labels.
+
+    With masking on the training device (--mlm_on_device), labels are left out and the training loop calls
+    mask_tokens itself. The collator is picklable, so with --n_process > 1 padding and masking run in the
+    DataLoader worker processes. A (examples, state) item of StreamingTokenDataset keeps its stream_state. """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, args, mask=True):
+        self.tokenizer = tokenizer
+        self.mlm = args.mlm
+        self.mlm_probability = args.mlm_probability
+        self.mask = mask
+        self.special_tokens = special_tokens_table(tokenizer)
+
+    def __call__(self, examples):
+        stream_state = None
+        if isinstance(examples, tuple):
+            examples, stream_state = examples
+        #if tokenizer._pad_token is None:
+        if self.tokenizer.pad_token is None:
+            inputs = pad_sequence(examples, batch_first=True).long()
+            attention_mask = torch.ones_like(inputs)
+        else:
+            inputs = pad_sequence(examples, batch_first=True, padding_value=self.tokenizer.pad_token_id).long()
+            attention_mask = inputs.ne(self.tokenizer.pad_token_id).long()
+
+        batch = {"input_ids": inputs, "attention_mask": attention_mask}
+        if self.mlm and self.mask:
+            # mask_tokens only reads mlm_probability from its args
+            batch["input_ids"], batch["labels"], batch["attention_mask"] = mask_tokens(
+                inputs, self.tokenizer, self, self.special_tokens
+            )
+        elif not self.mlm:
+            batch["labels"] = inputs.clone()
+        if stream_state is not None:
+            batch["stream_state"] = stream_state
+        return batch
+
+
+def dataloader_options(args, persistent_workers=True) -> Dict:
+    """ DataLoader options of the data pipeline: --n_process worker processes, prefetching and pinned memory """
+    options = {"pin_memory": args.device.type == "cuda"}
+    if args.n_process > 1:
+        options.update(
+            num_workers=args.n_process, prefetch_factor=args.prefetch_factor, persistent_workers=persistent_workers
+        )
+    return options
+
+
+def batch_to_device(batch, tokenizer: PreTrainedTokenizer, args, special_tokens):
+    """ Copy a collated batch to the training device, masking it there if the collator left labels out """
+    inputs = batch["input_ids"].to(args.device, non_blocking=True)
+    attention_mask = batch["attention_mask"].to(args.device, non_blocking=True)
+    if "labels" not in batch:
+        return mask_tokens(inputs, tokenizer, args, special_tokens)
+    return inputs, batch["labels"].to(args.device, non_blocking=True), attention_mask
+
+
+def autocast_context(args):
+    """ torch.autocast context of the forward pass: float16 with --fp16, bfloat16 with --bf16 (CUDA or CPU) """
+    dtype = torch.float16 if args.fp16 else torch.bfloat16
+    return torch.autocast(device_type=args.device.type, dtype=dtype, enabled=args.fp16 or args.bf16)
+
+
 def train(args, train_dataset, model: AutoModelForMaskedLM, tokenizer: PreTrainedTokenizer) -> Tuple[int, float]:
     """ Train the model """
     train_output_dir = args.output_dir
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
 
-    def collate(examples: List[torch.Tensor]):
-        #if tokenizer._pad_token is None:
-        if tokenizer.pad_token is None:
-            return pad_sequence(examples, batch_first=True)
-        return pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
+    collate = MLMCollator(tokenizer, args, mask=not args.mlm_on_device)
 
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(
-        train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate
-    )
+    if args.streaming:
+        # The stream batches, shuffles and shards by itself, and yields each batch with its position.
+        # Workers are restarted every epoch, so that they see the new epoch of the stream
+        train_dataloader = DataLoader(
+            train_dataset, batch_size=None, collate_fn=collate, **dataloader_options(args, persistent_workers=False)
+        )
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        if args.bucket_batches or args.max_tokens_per_batch > 0:
+            train_batch_sampler = BucketBatchSampler(
+                train_sampler,
+                train_dataset.lengths(),
+                args.train_batch_size,
+                bucket_size_multiplier=args.bucket_size_multiplier,
+                max_tokens=args.max_tokens_per_batch,
+            )
+            train_dataloader = DataLoader(
+                train_dataset, batch_sampler=train_batch_sampler, collate_fn=collate, **dataloader_options(args)
+            )
+        else:
+            train_dataloader = DataLoader(
+                train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate,
+                **dataloader_options(args)
+            )
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -217,26 +560,28 @@ def train(args, train_dataset, model: AutoModelForMaskedLM, tokenizer: PreTraine
         # Load in optimizer and scheduler states
         optimizer.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "optimizer.pt")))
         scheduler.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "scheduler.pt")))'''
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
+    # fp16 gradients are scaled to avoid underflow; bf16 has the range of fp32 and needs no scaling
+    scaler = torch.amp.GradScaler(args.device.type, enabled=args.fp16)
 
-    # multi-gpu training (should be after apex fp16 initialization)
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True
+            model,
+            device_ids=[args.local_rank],
+            output_device=args.local_rank,
+            find_unused_parameters=args.find_unused_parameters,
         )
 
     # Train!
     logger.info("***** Running training *****")
-    logger.info("  Num examples = %d", len(train_dataset))
+    if args.streaming:
+        logger.info("  Num examples = %d (streamed)", train_dataset.examples_per_shard() * train_dataset.num_shards)
+    else:
+        logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
     logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
     logger.info(
@@ -267,6 +612,15 @@ def train(args, train_dataset, model: AutoModelForMaskedLM, tokenizer: PreTraine
         except ValueError:
             logger.info("  Starting fine-tuning.")
 
+        if args.streaming:
+            stream_state_file = os.path.join(args.model_name_or_path, "stream_state_rank{}.pt".format(train_dataset.rank))
+            if os.path.isfile(stream_state_file):
+                # The stream restarts at its saved position instead of replaying the epoch's batches
+                train_dataset.load_state_dict(torch.load(stream_state_file, weights_only=False))
+                epochs_trained = train_dataset.epoch
+                steps_trained_in_current_epoch = 0
+                logger.info("  Resuming the data stream of epoch %d from %s", epochs_trained, stream_state_file)
+
     tr_loss, logging_loss = 0.0, 0.0
 
     model_to_resize = model.module if hasattr(model, "module") else model  # Take care of distributed/parallel training
@@ -278,74 +632,94 @@ def train(args, train_dataset, model: AutoModelForMaskedLM, tokenizer: PreTraine
     )
     set_seed(args)  # Added here for reproducibility
     ids_set = {'0': 0, '1': 0, '2': 0, '3': 0, '4': 0, '5': 0, '6': 0, '7': 0, '8': 0}
-    for _ in train_iterator:
+    special_tokens = special_tokens_table(tokenizer, device=args.device if args.mlm_on_device else None)
+    # Non-padding and total tokens of the batches since the last log, for the padding efficiency
+    real_tokens, batch_tokens = 0, 0
+    # Time spent waiting for batches, and the start of the current logging window
+    data_time, window_start = 0.0, time.perf_counter()
+    for epoch in train_iterator:
+        if args.streaming:
+            train_dataset.set_epoch(epoch)
+        if isinstance(train_dataloader.batch_sampler, BucketBatchSampler):
+            train_dataloader.batch_sampler.set_epoch(epoch)
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+        fetch_start = time.perf_counter()
         for step, batch in enumerate(epoch_iterator):
+            data_time += time.perf_counter() - fetch_start
 
             # Skip past any already trained steps if resuming training
             if steps_trained_in_current_epoch > 0:
                 steps_trained_in_current_epoch -= 1
+                fetch_start = time.perf_counter()
                 continue
+            if args.streaming:
+                train_dataset.record(batch["stream_state"])
+            batch_tokens += batch["attention_mask"].numel()
+            real_tokens += int(batch["attention_mask"].sum())
 
-            inputs, labels,attention_mask = mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
+            inputs, labels, attention_mask = batch_to_device(batch, tokenizer, args, special_tokens)
             # print(inputs.shape)
             # print(inputs)
             # for i in range(len(inputs)):
             #     for j in range(len(inputs[i])):
             #         ids_set[str(int(inputs[i][j]))] += 1
             # print(ids_set)
-            inputs = inputs.to(args.device)
-            labels = labels.to(args.device)
-            attention_mask = attention_mask.to(args.device) #########改了这里
             model.train()
-            #outputs = model(inputs, labels=labels) if args.mlm else model(inputs, labels=labels
-            outputs = model(input_ids=inputs, attention_mask=attention_mask, labels=labels) #########改了这里
-            loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
-            if args.n_gpu > 1:
-                loss = loss.mean()  # mean() to average on multi-gpu parallel training
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-
-            total_norm = 0.0
-            for p in model.parameters():
-                if p.grad is not None:
-                    param_norm = p.grad.data.norm(2)
-                    total_norm += param_norm.item() ** 2
-            total_norm = total_norm ** (1. / 2)
-
-            #for p in model.parameters():
-                #if p.grad is not None:
-                    #print(f'Parameter: {p.shape}, Gradient Norm: {p.grad.data.norm(2).item()}')
-
-
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
+            # Under DDP, gradients are all-reduced only on the last micro-batch of each accumulation cycle
+            accumulating = (step + 1) % args.gradient_accumulation_steps != 0
+            sync_context = model.no_sync() if args.local_rank != -1 and accumulating else contextlib.nullcontext()
+            with sync_context:
+                #outputs = model(inputs, labels=labels) if args.mlm else model(inputs, labels=labels
+                with autocast_context(args):
+                    outputs = model(input_ids=inputs, attention_mask=attention_mask, labels=labels) #########改了这里
+                loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
+                if args.n_gpu > 1:
+                    loss = loss.mean()  # mean() to average on multi-gpu parallel training
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
+
+                #for p in model.parameters():
+                    #if p.grad is not None:
+                        #print(f'Parameter: {p.shape}, Gradient Norm: {p.grad.data.norm(2).item()}')
+
+                scaler.scale(loss).backward()
 
             tr_loss += loss.item()
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-                optimizer.step()
+                # Norm of the gradients before clipping, left on the device until a logging step reads it.
+                # fp16 gradients are unscaled first, and steps with inf/nan gradients are skipped by the scaler
+                scaler.unscale_(optimizer)
+                grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()  # Update learning rate schedule
                 model.zero_grad()
                 global_step += 1
 
+                if args.logging_steps > 0 and global_step % args.logging_steps == 0:
+                    # Seconds per optimizer step spent waiting for data and in the rest of the step
+                    window_end = time.perf_counter()
+                    data_wait = data_time / args.logging_steps
+                    compute = (window_end - window_start) / args.logging_steps - data_wait
+                    data_time, window_start = 0.0, window_end
+
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
+                    total_norm = float(grad_norm)
                     output_train_file = os.path.join(train_output_dir,  "train_results.txt")
                     with open(output_train_file, 'a', encoding='utf-8') as file:
                         file.write(f"lr: {scheduler.get_lr()[0]}, global_step: {global_step}\n")
                         file.write(f"loss:{(tr_loss - logging_loss) / args.logging_steps},global_step: {global_step}\n")
                         file.write(f"grad_norm:{total_norm},global_step: {global_step}\n")  # 写入梯度范数
+                        file.write(f"padding_efficiency:{real_tokens / max(batch_tokens, 1)},global_step: {global_step}\n")
+                        file.write(f"data_wait_s:{data_wait},compute_s:{compute},global_step: {global_step}\n")
                         file.write(f"\n")
                     print("lr", scheduler.get_lr()[0], global_step)
                     print("loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
                     print("grad_norm:", total_norm)
+                    print("padding_efficiency:", real_tokens / max(batch_tokens, 1))
+                    print("data_wait_s:", data_wait, "compute_s:", compute)
                     logging_loss = tr_loss
+                    real_tokens, batch_tokens = 0, 0
 
                     if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % 3000000 == 0:
                         # Log metrics
@@ -376,6 +750,16 @@ def train(args, train_dataset, model: AutoModelForMaskedLM, tokenizer: PreTraine
                     torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
                     logger.info("Saving optimizer and scheduler states to %s", output_dir)
 
+                if args.streaming and args.save_steps > 0 and global_step % args.save_steps == 0:
+                    # Every rank saves the position of its own shards
+                    output_dir = os.path.join(args.output_dir, "checkpoint-{}".format(global_step))
+                    os.makedirs(output_dir, exist_ok=True)
+                    torch.save(
+                        train_dataset.state_dict(),
+                        os.path.join(output_dir, "stream_state_rank{}.pt".format(train_dataset.rank)),
+                    )
+
+            fetch_start = time.perf_counter()
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
@@ -399,15 +783,12 @@ def evaluate(args, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, prefi
 
     # Note that DistributedSampler samples randomly
 
-    def collate(examples: List[torch.Tensor]):
-        #if tokenizer._pad_token is None:
-        if tokenizer.pad_token is None:
-            return pad_sequence(examples, batch_first=True)
-        return pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
+    collate = MLMCollator(tokenizer, args, mask=not args.mlm_on_device)
 
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=collate
+        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=collate,
+        **dataloader_options(args, persistent_workers=False)
     )
 
     # multi-gpu evaluate
@@ -421,14 +802,12 @@ def evaluate(args, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, prefi
     eval_loss = 0.0
     nb_eval_steps = 0
     model.eval()
+    special_tokens = special_tokens_table(tokenizer, device=args.device if args.mlm_on_device else None)
 
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        inputs, labels, attention_mask = mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
-        inputs = inputs.to(args.device)
-        labels = labels.to(args.device)
-        attention_mask = attention_mask.to(args.device)
+        inputs, labels, attention_mask = batch_to_device(batch, tokenizer, args, special_tokens)
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast_context(args):
             outputs = model(inputs, attention_mask=attention_mask,labels=labels) if args.mlm else model(inputs, labels=labels)
             lm_loss = outputs[0]
             eval_loss += lm_loss.mean().item()
@@ -456,7 +835,8 @@ def main():
 
     # Required parameters
     parser.add_argument(
-        "--train_data_file", default=None, type=str, required=True, help="The input training data file (a text file)."
+        "--train_data_file", default=None, type=str, required=True,
+        help="The input training data file (a text file, or the prefix of a token store written by token_store.py)."
     )
     parser.add_argument(
         "--output_dir",
@@ -473,7 +853,7 @@ def main():
         "--eval_data_file",
         default=None,
         type=str,
-        help="An optional input evaluation data file to evaluate the perplexity on (a text file).",
+        help="An optional input evaluation data file to evaluate the perplexity on (a text file or a token store).",
     )
     parser.add_argument(
         "--line_by_line",
@@ -519,9 +899,41 @@ def main():
         "--block_size",
         default=-1,
         type=int,
-        help="Optional input sequence length after tokenization."
-             "The training dataset will be truncated in block of this size for training."
-             "Default to the model max input length for single sentence inputs (take into account special tokens).",
+        help="Optional input sequence length after tokenization. "
+             "Longer sequences of the training and evaluation data are truncated to this many tokens. "
+             "Default to the model max input length (max_position_embeddings of the config).",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the training data through a shuffle buffer instead of sampling the whole dataset. "
+             "The stream position is saved with every checkpoint, so --should_continue resumes mid-epoch.",
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size", default=10000, type=int, help="Number of sequences in the --streaming shuffle buffer."
+    )
+    parser.add_argument(
+        "--bucket_batches",
+        action="store_true",
+        help="Batch training sequences of similar length together to reduce padding.",
+    )
+    parser.add_argument(
+        "--bucket_size_multiplier",
+        default=100,
+        type=int,
+        help="With --bucket_batches, sort groups of batch size * this many sequences by length before batching.",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        default=0,
+        type=int,
+        help="If > 0: fill each training batch with up to this many (padded) tokens instead of a fixed number "
+             "of sequences. Implies --bucket_batches.",
+    )
+    parser.add_argument(
+        "--mlm_on_device",
+        action="store_true",
+        help="Copy each batch to the training device first and build the MLM masks there instead of on the CPU.",
     )
     parser.add_argument("--do_train", action="store_true", help="Whether to run training.")
     parser.add_argument("--do_eval", action="store_true", help="Whether to run eval on the dev set.")
@@ -577,21 +989,39 @@ def main():
         "--overwrite_cache", action="store_true", help="Overwrite the cached training and evaluation sets"
     )
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
-    parser.add_argument("--n_process", type=int, default=1, help="")
+    parser.add_argument(
+        "--n_process",
+        type=int,
+        default=1,
+        help="If > 1: pad and mask batches in this many DataLoader worker processes instead of the main process.",
+    )
+    parser.add_argument(
+        "--prefetch_factor", type=int, default=2, help="Batches prefetched by each DataLoader worker (--n_process > 1)."
+    )
 
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="Whether to use float16 mixed precision (torch.autocast with gradient scaling) instead of 32-bit",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Whether to use bfloat16 mixed precision (torch.autocast, on CUDA or CPU) instead of 32-bit",
     )
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
         default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-             "See details at https://nvidia.github.io/apex/amp.html",
+        help="Ignored, kept so that commands written for the former NVIDIA apex fp16 training still run.",
     )
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
+    parser.add_argument(
+        "--find_unused_parameters",
+        action="store_true",
+        help="For distributed training: let DistributedDataParallel search the graph for parameters without "
+             "gradients on every backward pass. Only needed if some parameters are unused in the forward pass.",
+    )
     parser.add_argument("--server_ip", type=str, default="", help="For distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="For distant debugging.")
     args = parser.parse_args()
@@ -606,6 +1036,10 @@ def main():
             "Cannot do evaluation without an evaluation data file. Either supply a file to --eval_data_file "
             "or remove the --do_eval argument."
         )
+    if args.fp16 and args.bf16:
+        raise ValueError("--fp16 and --bf16 cannot be used together.")
+    if args.streaming and (args.bucket_batches or args.max_tokens_per_batch > 0):
+        raise ValueError("--bucket_batches and --max_tokens_per_batch cannot be combined with --streaming.")
     if args.should_continue:
         sorted_checkpoints = _sorted_checkpoints(args)
         if len(sorted_checkpoints) == 0:
@@ -657,7 +1091,7 @@ def main():
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        args.fp16,
+        "fp16" if args.fp16 else "bf16" if args.bf16 else False,
     )
 
     # Set seed
@@ -692,10 +1126,10 @@ def main():
     # print(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)))
 
     if args.block_size <= 0:
-        args.block_size = 512 #tokenizer.max_len
+        args.block_size = config.max_position_embeddings
         # Our input block size will be the max possible for the model
     else:
-        args.block_size = 512 #min(args.block_size, tokenizer.max_len)
+        args.block_size = min(args.block_size, config.max_position_embeddings)
 
     if args.model_name_or_path:
         model = model_class.from_pretrained(
@@ -1,82 +1,615 @@
 import json
 import os
 import gc
+import hashlib
+import heapq
+from bisect import bisect_left, insort
+from functools import lru_cache, partial
+import re
 import ladderpath as lp
+import queue
+import threading
 import time
-from multiprocessing import Process
+import traceback
+from multiprocessing import Lock, Process, Queue, Value
+import numpy as np
 import psutil
 import pandas as pd
+from sequence_store import SequenceStore, is_sequence_store
+from pom_format import write_pom
 
-# Get current process
-process = psutil.Process(os.getpid())
+# Ladderpath parameters, also part of the cache key of every batch
+LADDERPATH_PARAMS = {
+    "info": 'V1.0.0.20240910_Alpha',
+    "estimate_eta": False,
+    "estimate_eta_para": [10, 'global'],
+}
+
+# How batch results are written: pom_format "binary" (token table plus multiplicity arrays, see
+# pom_format.py, gzip-compressed with compress) or "json" (indented, as before); save_ladder_json
+# additionally dumps the full Ladderpath JSON to ./ladder_{batch_index}.json
+DEFAULT_OUTPUT_OPTIONS = {
+    "pom_format": "binary",
+    "compress": False,
+    "save_ladder_json": False,
+}
 
 # Define set of valid bases
 valid_bases = {"A", "T", "C", "G"}
+# Maximal runs of valid bases, i.e. the fragments left after breaking at non-standard characters
+valid_fragment_pattern = re.compile("[ATCG]+")
 
 def log_memory_usage(stage):
     """
     Print current memory usage to help identify memory spikes.
     """
-    mem_info = process.memory_info()
+    mem_info = psutil.Process(os.getpid()).memory_info()  # Measure the calling (worker) process
     print(f"[{stage}] Current memory usage: {mem_info.rss / 1024 ** 2:.2f} MB")
 
-def process_batch(batch_index, current_sequences, output_folder):
+def run_ladderpath(batch_index, current_sequences, save_ladder_json=False):
     """
-    Process a single batch of data.
+    Run Ladderpath on a batch and return its POM dictionary, or None if the input is invalid.
     """
-    time.sleep(2)
-    print(
-        f"Processing batch {batch_index}, Total length: {sum(len(seq) for seq in current_sequences)}, List length: {len(current_sequences)}"
-    )
     # Call ladderpath function
     lpjson = lp.get_ladderpath(
         current_sequences,
-        info='V1.0.0.20240910_Alpha',
-        estimate_eta=False,
-        estimate_eta_para=[10, 'global'],
-        save_file_name=f'./ladder_{batch_index}.json',
+        **LADDERPATH_PARAMS,
+        save_file_name=f'./ladder_{batch_index}.json' if save_ladder_json else None,
         show_version=True
     )
 
     # Check if the return value is valid
     if lpjson is None:
-        print(f"Input for batch {batch_index} is invalid, skipping.")
-    else:
-        # Display the 3 Ladderpath indices
-        index3 = lp.disp3index(lpjson)
-        print(f"Ladderpath indices for batch {batch_index}: {index3}")
+        return None
+
+    # Display the 3 Ladderpath indices
+    index3 = lp.disp3index(lpjson)
+    print(f"Ladderpath indices for batch {batch_index}: {index3}")
 
-        # Obtain the Poset-Multiset (POM) representation of the Ladderpath
-        pom, pom_str = lp.POM_from_JSON(lpjson, display_str=False)
+    # Obtain the Poset-Multiset (POM) representation of the Ladderpath
+    pom, pom_str = lp.POM_from_JSON(lpjson, display_str=False)
+    return pom
+
+def pom_file_name(batch_index, output_options):
+    """
+    File name of a batch's POM output for the chosen format.
+    """
+    if output_options["pom_format"] == "json":
+        return f"pom_data_batch_{batch_index}.json"
+    return f"pom_data_batch_{batch_index}.pom" + (".gz" if output_options["compress"] else "")
+
+def process_batch(batch_index, current_sequences, output_folder, cache=None, output_options=None):
+    """
+    Process a single batch of data.
+    """
+    output_options = DEFAULT_OUTPUT_OPTIONS if output_options is None else output_options
+    print(
+        f"Processing batch {batch_index}, Total length: {sum(len(seq) for seq in current_sequences)}, List length: {len(current_sequences)}"
+    )
+    save_ladder_json = output_options["save_ladder_json"]
+    if cache is not None:
+        cache_key = cache.key(current_sequences)
+        found, pom = cache.get(cache_key)
+        if found:
+            print(f"Batch {batch_index} found in the Ladderpath cache")
+        else:
+            pom = run_ladderpath(batch_index, current_sequences, save_ladder_json)
+            cache.put(cache_key, pom)
+    else:
+        pom = run_ladderpath(batch_index, current_sequences, save_ladder_json)
 
-        pom_file_path = f"{output_folder}/pom_data_batch_{batch_index}.json"
-        with open(pom_file_path, 'w') as json_file:
-            json.dump(pom, json_file, indent=4)
+    pom_file_path = None
+    if pom is None:
+        print(f"Input for batch {batch_index} is invalid, skipping.")
+    else:
+        pom_file_path = f"{output_folder}/{pom_file_name(batch_index, output_options)}"
+        # Write to a temporary file and rename it, so a killed run never leaves a truncated POM file
+        if output_options["pom_format"] == "json":
+            with open(pom_file_path + ".tmp", 'w') as json_file:
+                json.dump(pom, json_file, indent=4)
+        else:
+            write_pom(pom, pom_file_path + ".tmp", compress=output_options["compress"])
+        os.replace(pom_file_path + ".tmp", pom_file_path)
         print(f"POM dictionary for batch {batch_index} saved to {pom_file_path}")
 
     # Perform garbage collection after the subprocess completes the task
     print(f"Batch {batch_index} finished, starting garbage collection")
     gc.collect()  # Manually trigger garbage collection
     log_memory_usage(f"After processing batch {batch_index}")  # Memory checkpoint
+    return pom_file_path
+
+class LadderpathCache:
+    """
+    On-disk cache of POM results keyed by a hash of the batch's sequences and the Ladderpath
+    parameters, with size-bounded least-recently-used eviction and hit/miss counters shared
+    by all worker processes.
+    """
+    def __init__(self, cache_dir, max_bytes, params=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.params_key = json.dumps(LADDERPATH_PARAMS if params is None else params, sort_keys=True)
+        self.hits = Value('q', 0)
+        self.misses = Value('q', 0)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.evict()  # Apply a lowered size limit right away
+
+    def key(self, current_sequences):
+        digest = hashlib.sha1(self.params_key.encode())
+        digest.update(batch_input_hash(current_sequences).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return (found, pom). A hit refreshes the entry's mtime, which orders the LRU eviction.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                pom = json.load(f)["pom"]
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            with self.misses.get_lock():
+                self.misses.value += 1
+            return False, None
+        with self.hits.get_lock():
+            self.hits.value += 1
+        return True, pom
+
+    def put(self, key, pom):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"pom": pom}, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another worker
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return
+        for mtime, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+    def stats(self):
+        hits, misses = self.hits.value, self.misses.value
+        lookups = hits + misses
+        hit_rate = hits / lookups if lookups else 0.0
+        return f"Ladderpath cache: {hits} hits, {misses} misses, hit rate {hit_rate:.1%}"
+
+def batch_input_hash(current_sequences):
+    """
+    Hash of a batch's sequence list, used to recognize an already completed batch on restart.
+    """
+    digest = hashlib.sha1()
+    for sequence in current_sequences:
+        digest.update(sequence.encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def load_manifest(manifest_path):
+    """
+    Read the run manifest (one JSON record per line) into {batch_index: latest record}.
+    """
+    records = {}
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Last line of a run that was killed while writing
+            records[record["batch_index"]] = record
+    return records
+
+def append_manifest(manifest_path, record, lock):
+    """
+    Append one batch record to the run manifest, serialized across workers by lock.
+    """
+    with lock:
+        with open(manifest_path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def is_batch_complete(record, input_hash):
+    """
+    A batch can be skipped if it finished with the same input and its POM file is still there.
+    """
+    if record is None or record["input_hash"] != input_hash:
+        return False
+    if record["status"] == "invalid":
+        return True
+    return record["status"] == "done" and os.path.exists(record["output_path"])
+
+class PeakMemoryMonitor:
+    """
+    Sample the RSS of the current process in a background thread and keep its peak.
+    """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.base_rss = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.base_rss = self.peak_rss = self.process.memory_info().rss
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        return False
+
+class AdmissionController:
+    """
+    Memory-aware admission control for the Ladderpath workers.
+
+    Workers report the base and peak RSS of every batch, from which the controller keeps the
+    largest observed memory cost per character. It then picks the batch length and the number
+    of batches running at once so that they fit memory_budget bytes, and holds new batches back
+    while the machine's available memory is below min_available bytes. Until the first batch
+    has been measured, only warmup_batches batches run at once.
+    """
+    def __init__(self, memory_budget, min_available, max_workers, min_length, max_length, warmup_batches=2):
+        self.memory_budget = memory_budget
+        self.min_available = min_available
+        self.max_workers = max_workers
+        self.min_length = min_length
+        self.max_length = max_length
+        self.warmup_batches = warmup_batches
+        self.bytes_per_char = None
+        self.base_rss = 0
+
+    def record(self, length, base_rss, peak_rss):
+        """
+        Update the memory model with one finished batch.
+        """
+        self.base_rss = max(self.base_rss, base_rss)
+        if length > 0:
+            ratio = max(peak_rss - base_rss, 0) / length
+            self.bytes_per_char = ratio if self.bytes_per_char is None else max(self.bytes_per_char, ratio)
+
+    def batch_length(self):
+        """
+        Largest batch length that lets every worker run at once within the budget (at least min_length).
+        """
+        if not self.bytes_per_char:
+            return self.max_length
+        per_worker = self.memory_budget / self.max_workers - self.base_rss
+        length = int(per_worker / self.bytes_per_char) if per_worker > 0 else 0
+        return max(self.min_length, min(self.max_length, length))
+
+    def max_concurrent(self):
+        """
+        Number of batches of batch_length() that fit in the budget at once.
+        """
+        if self.bytes_per_char is None:
+            return min(self.warmup_batches, self.max_workers)
+        per_batch = self.base_rss + self.bytes_per_char * self.batch_length()
+        return max(1, min(self.max_workers, int(self.memory_budget // max(per_batch, 1))))
+
+    def admit(self, in_flight):
+        """
+        Whether one more batch may start now. A batch is always admitted when none is running.
+        """
+        if in_flight == 0:
+            return True
+        if in_flight >= self.max_concurrent():
+            return False
+        return psutil.virtual_memory().available >= self.min_available
+
+    def describe(self):
+        if self.bytes_per_char is None:
+            return "Admission control: no batch measured yet"
+        return (
+            f"Admission control: {self.bytes_per_char:.1f} bytes/char, worker base {self.base_rss / 1024 ** 2:.0f} MB, "
+            f"batch length {self.batch_length()}, up to {self.max_concurrent()} concurrent batches"
+        )
+
+def batch_worker(task_queue, output_folder, manifest_path, manifest_lock, cache, done_queue, output_options,
+                 current_batch=None):
+    """
+    Long-lived worker: process batches from the task queue until the stop sentinel (None) arrives.
+    The index of the batch being processed is published in current_batch (0 while idle).
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_index, current_sequences, input_hash = task
+        if current_batch is not None:
+            current_batch.value = batch_index
+        monitor = PeakMemoryMonitor()
+        start_time = time.time()
+        try:
+            with monitor:
+                pom_file_path = process_batch(batch_index, current_sequences, output_folder, cache, output_options)
+            status = "invalid" if pom_file_path is None else "done"
+        except Exception:
+            # A failing batch must not take the worker (and its queue share) down with it
+            print(f"Batch {batch_index} failed:")
+            traceback.print_exc()
+            pom_file_path, status = None, "failed"
+        if done_queue is not None:
+            batch_length = sum(len(seq) for seq in current_sequences)
+            done_queue.put((batch_index, batch_length, monitor.base_rss, monitor.peak_rss, time.time() - start_time))
+        if manifest_path is not None:
+            append_manifest(manifest_path, {
+                "batch_index": batch_index,
+                "input_hash": input_hash,
+                "status": status,
+                "output_path": pom_file_path
+            }, manifest_lock)
+        if current_batch is not None:
+            current_batch.value = 0
+
+class WorkerPool:
+    """
+    The persistent batch workers. Each worker publishes the batch it is processing, so a worker
+    that dies mid-batch (killed by the OOM killer, crashed inside ladderpath) is noticed: reap()
+    returns its batch and starts a replacement in its slot, keeping num_workers workers running.
+    """
+    def __init__(self, num_workers, worker_args):
+        self.worker_args = worker_args
+        self.workers = [None] * num_workers
+        self.current_batches = [None] * num_workers
+        for slot in range(num_workers):
+            self.start(slot)
+
+    def start(self, slot):
+        current_batch = Value('q', 0, lock=False)
+        worker = Process(target=batch_worker, args=(*self.worker_args, current_batch))
+        worker.start()
+        self.workers[slot] = worker
+        self.current_batches[slot] = current_batch
+
+    def any_alive(self):
+        return any(worker.is_alive() for worker in self.workers)
+
+    def reap(self):
+        """
+        Replace the workers that died while holding a batch and return the indices of those batches.
+        A worker that died idle is not replaced, whatever killed it would kill its replacement too.
+        """
+        lost = []
+        for slot, worker in enumerate(self.workers):
+            if worker.is_alive() or worker.exitcode == 0:
+                continue
+            batch_index = self.current_batches[slot].value
+            if batch_index == 0:
+                continue
+            print(f"Worker {worker.pid} died (exit code {worker.exitcode}) while processing batch {batch_index}, "
+                  f"starting a replacement")
+            lost.append(batch_index)
+            self.start(slot)
+        return lost
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+def reap_workers(pool, pending, lost, manifest_path, manifest_lock):
+    """
+    Replace the workers that died mid-batch, moving their batches from pending to lost and
+    recording them as failed in the manifest, so a rerun computes them again.
+    """
+    for batch_index in pool.reap():
+        if batch_index not in pending:
+            continue  # Its report arrived before the worker died
+        lost[batch_index] = input_hash = pending.pop(batch_index)
+        if manifest_path is not None:
+            append_manifest(manifest_path, {
+                "batch_index": batch_index,
+                "input_hash": input_hash,
+                "status": "failed",
+                "output_path": None
+            }, manifest_lock)
+
+def put_task(task_queue, task, pool, reap):
+    """
+    Put a task on the bounded queue, blocking while it is full and replacing dead workers
+    meanwhile (reap), but fail if every worker has exited.
+    """
+    while True:
+        try:
+            task_queue.put(task, timeout=10)
+            return
+        except queue.Full:
+            reap()
+            if not pool.any_alive():
+                raise RuntimeError("All Ladderpath workers have exited, aborting")
+
+def drain_reports(done_queue, reports, block=False):
+    """
+    Move the finished-batch reports from the done queue into reports, returns how many arrived.
+    """
+    count = 0
+    try:
+        if block:
+            reports.append(done_queue.get(timeout=1))
+            count += 1
+        while True:
+            reports.append(done_queue.get_nowait())
+            count += 1
+    except queue.Empty:
+        pass
+    return count
+
+def collect_reports(done_queue, reports, pending, lost, block=False):
+    """
+    Drain the finished-batch reports (see drain_reports) and take their batches off pending.
+    A batch reported after its worker was reaped did finish, so it is no longer lost.
+    """
+    count = drain_reports(done_queue, reports, block)
+    for report in reports[len(reports) - count:]:
+        if pending.pop(report[0], None) is None:
+            lost.pop(report[0], None)
+    return count
+
+def wait_for_admission(admission, done_queue, reports, pending, lost, pool, reap):
+    """
+    Block until the admission controller lets one more batch start, folding in the memory
+    reports of finished batches meanwhile. The batches in flight are the pending ones, so a
+    batch lost with its worker (see reap_workers) frees its place like a finished one.
+    """
+    block = False
+    while True:
+        count = collect_reports(done_queue, reports, pending, lost, block)
+        for batch_index, batch_length, base_rss, peak_rss, seconds in reports[len(reports) - count:]:
+            admission.record(batch_length, base_rss, peak_rss)
+        reap()
+        if admission.admit(len(pending)):
+            return
+        if not pool.any_alive():
+            raise RuntimeError("All Ladderpath workers have exited, aborting")
+        block = True
+
+def report_makespan(batch_costs, reports, num_workers, wall_time):
+    """
+    Print the makespan predicted from the planned batch costs next to the actual one.
+    """
+    costs = [batch_costs[batch_index] for batch_index in sorted(batch_costs)]
+    predicted_cost = predict_makespan(costs, num_workers)
+    lower_bound = sum(costs) / num_workers
+    print(f"Predicted makespan: {predicted_cost:.0f} cost units (lower bound {lower_bound:.0f})")
+
+    measured = [(batch_costs[r[0]], r[4]) for r in reports if r[0] in batch_costs]
+    measured_cost = sum(cost for cost, seconds in measured)
+    if measured_cost > 0:
+        seconds_per_cost = sum(seconds for cost, seconds in measured) / measured_cost
+        print(f"Predicted makespan: {predicted_cost * seconds_per_cost:.1f} s at the measured "
+              f"{seconds_per_cost:.3g} s per cost unit, actual makespan: {wall_time:.1f} s")
+
+def run_batches(batches, output_folder, num_workers, max_pending_batches, manifest_path=None, cache=None,
+                admission=None, batch_costs=None, output_options=None):
+    """
+    Feed batches to num_workers persistent worker processes through a bounded queue.
+    A new batch starts as soon as any worker is free, and at most max_pending_batches
+    batches wait in memory, so the generator is only advanced when there is room.
+    With a manifest, batches recorded as completed with the same input hash are skipped,
+    so a restarted run only recomputes the missing ones.
+    With an AdmissionController, a batch is only handed out once the controller admits it.
+    With batch_costs ({batch_index: cost} from plan_batches), the predicted and actual makespan are reported.
+    output_options selects the POM output format (see DEFAULT_OUTPUT_OPTIONS).
+    A worker that dies mid-batch is replaced; the batches handed out but never reported are
+    listed and a RuntimeError is raised at the end, after all other batches have run.
+    """
+    output_options = DEFAULT_OUTPUT_OPTIONS if output_options is None else output_options
+    start_time = time.time()
+    manifest = load_manifest(manifest_path)
+    manifest_lock = Lock()
+    task_queue = Queue(maxsize=max_pending_batches)
+    done_queue = Queue()
+    reports = []
+    pending = {}  # {batch_index: input_hash} of the batches handed out and not reported yet
+    lost = {}  # The same for the batches whose worker died while processing them
+    pool = WorkerPool(
+        num_workers, (task_queue, output_folder, manifest_path, manifest_lock, cache, done_queue, output_options)
+    )
+    reap = partial(reap_workers, pool, pending, lost, manifest_path, manifest_lock)
+
+    num_batches = 0
+    num_skipped = 0
+    for batch_index, current_sequences in enumerate(batches, start=1):
+        num_batches += 1
+        input_hash = batch_input_hash(current_sequences)
+        if is_batch_complete(manifest.get(batch_index), input_hash):
+            num_skipped += 1
+            if batch_costs is not None:
+                batch_costs.pop(batch_index, None)
+            continue
+        reap()
+        if admission is not None:
+            wait_for_admission(admission, done_queue, reports, pending, lost, pool, reap)
+        pending[batch_index] = input_hash
+        put_task(task_queue, (batch_index, current_sequences, input_hash), pool, reap)
+
+    # One stop sentinel per worker, then wait for the queue to drain. The done queue is emptied
+    # while waiting, a worker cannot exit before everything it put on a queue has been read.
+    # A replacement worker takes the sentinel its dead predecessor never got to.
+    for _ in range(num_workers):
+        put_task(task_queue, None, pool, reap)
+    while True:
+        collect_reports(done_queue, reports, pending, lost, block=True)
+        reap()
+        if not pool.any_alive():
+            break
+    pool.join()
+    collect_reports(done_queue, reports, pending, lost)
+
+    if num_skipped:
+        print(f"Skipped {num_skipped} batches already completed in {manifest_path}")
+    if cache is not None:
+        print(cache.stats())
+    if admission is not None:
+        print(admission.describe())
+    if batch_costs:
+        report_makespan(batch_costs, reports, num_workers, time.time() - start_time)
+    missing = sorted(set(pending) | set(lost))
+    if missing:
+        print(f"{len(missing)} batches got no result because their worker died: {missing}")
+        raise RuntimeError(f"{len(missing)} of {num_batches} batches are missing, rerun to compute them")
+    return num_batches
+
+def load_sequences(file_path):
+    """
+    Load the step-1 sequences, either from the CSV file or from a memory-mapped sequence store.
+    """
+    if is_sequence_store(file_path):
+        return SequenceStore(file_path)
+    data = pd.read_csv(file_path)
+    return data['DNA_Sequence']
+
+def split_valid_fragments(sequence):
+    """
+    Uppercase a sequence and split it into its runs of valid bases.
+    """
+    return valid_fragment_pattern.findall(sequence.upper())
 
 # Define generator function
 def sequence_generator(sequences, max_length):
+    # max_length may also be a callable, re-evaluated for every sequence (adaptive batch sizing)
+    get_max_length = max_length if callable(max_length) else None
     current_length = 0
     current_sequences = []
     for sequence in sequences:
-        sequence = sequence.upper()  # Convert to uppercase
+        if get_max_length is not None:
+            max_length = get_max_length()
         # Split sequence: break at non-standard characters
-        fragments = []
-        fragment = []
-        for char in sequence:
-            if char in valid_bases:
-                fragment.append(char)  # Build valid fragment
-            else:
-                if fragment:
-                    fragments.append("".join(fragment))  # Save valid fragment
-                    fragment = []  # Reset fragment
-        if fragment:
-            fragments.append("".join(fragment))  # Save the last valid fragment
+        fragments = split_valid_fragments(sequence)
 
         # Add split fragments to current_sequences
         for frag in fragments:
@@ -108,33 +641,136 @@ def sequence_generator(sequences, max_length):
     if current_sequences:
         yield current_sequences
 
+def fragment_spans(sequences, max_length):
+    """
+    Locate every fragment sequence_generator would emit, as arrays of (sequence index, start, end):
+    runs of valid bases longer than 1, with runs longer than max_length cut into max_length pieces.
+    """
+    seq_indices, starts, ends = [], [], []
+    for seq_index, sequence in enumerate(sequences):
+        for match in valid_fragment_pattern.finditer(sequence.upper()):
+            start, end = match.span()
+            if end - start <= 1:
+                continue
+            for piece_start in range(start, end, max_length):
+                seq_indices.append(seq_index)
+                starts.append(piece_start)
+                ends.append(min(piece_start + max_length, end))
+    return np.array(seq_indices, dtype=np.int64), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+def pack_fragments(lengths, max_length):
+    """
+    Best-fit-decreasing bin packing: take fragments longest first and put each into the fullest
+    batch that still has room, so batches come out close to max_length. Returns lists of fragment ids.
+    """
+    bins = []
+    free_space = []  # Sorted (remaining capacity, bin id)
+    for fragment_id in np.argsort(-lengths, kind='stable'):
+        length = int(lengths[fragment_id])
+        position = bisect_left(free_space, (length, -1))
+        if position < len(free_space):
+            remaining, bin_id = free_space.pop(position)
+            bins[bin_id].append(fragment_id)
+            insort(free_space, (remaining - length, bin_id))
+        else:
+            bins.append([fragment_id])
+            insort(free_space, (max_length - length, len(bins) - 1))
+    return bins
+
+def predict_makespan(costs, num_workers):
+    """
+    Simulate num_workers workers taking batches in the given order, each batch going to the first free worker.
+    """
+    finish_times = [0.0] * num_workers
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times) if costs else 0.0
+
+def plan_batches(sequences, max_length, cost_exponent=1.0):
+    """
+    Plan all batches up front: pack the fragments into length-balanced batches and order them
+    by decreasing predicted cost (total length ** cost_exponent), so the most expensive batches
+    start first. Returns (plan, costs): plan is a list of fragment-span arrays per batch.
+    """
+    seq_indices, starts, ends = fragment_spans(sequences, max_length)
+    bins = pack_fragments(ends - starts, max_length)
+    costs = [float(np.sum(ends[fragment_ids] - starts[fragment_ids])) ** cost_exponent for fragment_ids in bins]
+    order = sorted(range(len(bins)), key=lambda i: costs[i], reverse=True)
+
+    plan = []
+    for i in order:
+        # Keep the fragments of a batch in genome order
+        fragment_ids = np.sort(np.asarray(bins[i], dtype=np.int64))
+        plan.append((seq_indices[fragment_ids], starts[fragment_ids], ends[fragment_ids]))
+    return plan, [costs[i] for i in order]
+
+def planned_batch_generator(sequences, plan):
+    """
+    Materialize the batches of a plan from plan_batches, in planned order.
+    """
+    get_sequence = sequences.iloc.__getitem__ if hasattr(sequences, "iloc") else sequences.__getitem__
+    get_sequence = lru_cache(maxsize=16)(get_sequence)  # Decoding a stored sequence can be expensive
+    for seq_indices, starts, ends in plan:
+        yield [
+            get_sequence(int(seq_index))[start:end].upper()
+            for seq_index, start, end in zip(seq_indices, starts, ends)
+        ]
+
 # Main processing logic
 if __name__ == "__main__":
     max_length = 1000000  # Max length limit
     output_folder = r'./hg19_json_file'
-    file_path = r"./hg19_gene_annotation.csv"
-    data = pd.read_csv(file_path)
-    sequences = data['DNA_Sequence']
+    file_path = r"./hg19_gene_annotation.csv"  # Or the sequence store prefix, e.g. "./hg19_gene_annotation"
+    sequences = load_sequences(file_path)
 
     num_workers = 50 # Control concurrency, adjust based on CPU and memory
-    processes = []  # List to store processes
-    batch_index = 1
-    # Use generator to create arguments
-    for current_sequences in sequence_generator(sequences, max_length):
-        # Create and start each subprocess
-        process = Process(target=process_batch, args=(batch_index, current_sequences, output_folder))
-        process.start()
-        processes.append(process)
-
-        # Control concurrency, wait for some processes to finish
-        if len(processes) >= num_workers:
-            for p in processes:
-                p.join()  # Wait for subprocess to finish
-            processes = []  # Clear process list
-        batch_index += 1
-
-    # Wait for all processes to finish
-    for p in processes:
-        p.join()
+    max_pending_batches = 2 * num_workers  # Batches generated ahead of the workers (bounds memory)
+    os.makedirs(output_folder, exist_ok=True)
+    # Record every finished batch, rerunning the script resumes from the batches still missing
+    manifest_path = os.path.join(output_folder, "manifest.jsonl")
+    # Reuse POM results of identical batches across runs (set cache_dir to None to disable)
+    cache_dir = r'./ladderpath_cache'
+    cache_max_gb = 50
+    cache = LadderpathCache(cache_dir, int(cache_max_gb * 1024 ** 3)) if cache_dir else None
+
+    # Adaptive mode: measure each worker's peak memory per character, then size batches and the number
+    # of concurrent batches to fit memory_budget_gb, and hold batches back while available memory is low
+    adaptive_memory = False
+    memory_budget_gb = 0.8 * psutil.virtual_memory().total / 1024 ** 3
+    min_available_gb = 8
+    min_batch_length = 100000
+    admission = None
+    batch_length = max_length
+    if adaptive_memory:
+        admission = AdmissionController(
+            int(memory_budget_gb * 1024 ** 3), int(min_available_gb * 1024 ** 3), num_workers, min_batch_length, max_length
+        )
+        batch_length = admission.batch_length
+
+    # POM output: compact binary files (optionally gzip-compressed), the full Ladderpath JSON dump is opt-in
+    output_options = {
+        "pom_format": "binary",
+        "compress": False,
+        "save_ladder_json": False,
+    }
+
+    # Balanced mode: plan all batches up front with longest-first bin packing over the fragment lengths,
+    # and start the most expensive batches first to shorten the tail of the run
+    balanced_packing = False
+    batch_costs = None
+    if balanced_packing:
+        plan, costs = plan_batches(sequences, max_length)
+        batch_costs = {batch_index: cost for batch_index, cost in enumerate(costs, start=1)}
+        print(f"Planned {len(plan)} batches, predicted makespan {predict_makespan(costs, num_workers):.0f} cost units")
+        batches = planned_batch_generator(sequences, plan)
+    else:
+        batches = sequence_generator(sequences, batch_length)
+
+    # Use generator to create arguments, persistent workers pick batches up as soon as they are free
+    num_batches = run_batches(
+        batches, output_folder, num_workers, max_pending_batches, manifest_path, cache, admission, batch_costs,
+        output_options
+    )
+    print(f"Processed {num_batches} batches")
 
     print("Main program execution completed")
\ No newline at end of file
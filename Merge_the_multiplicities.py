@@ -1,38 +1,255 @@
+import heapq
 import json
+import math
 import os
+import random
+import time
 from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool
+from pom_format import is_pom_file, iter_pom_counts
+from bulid_vocab import select_top_tokens
 
-# Define file paths
-file_paths = [
-    './hg19_json_file_1000000',
-]
-
-# Collect all JSON file paths
-files = []
-for file_path in file_paths:
-    files.extend([os.path.join(file_path, f) for f in os.listdir(file_path) if f.endswith('.json')])
-
-# Use defaultdict to accumulate multiplicities
-token_counts = defaultdict(int)
-
-# Read files and accumulate multiplicities
-for file in files:
-    with open(file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        for layer in data.values():  # Iterate through each layer
-            for token, count in layer.items():
-                # Only count if the key length is greater than or equal to 1
-                if len(token) >= 1:
-                    token_counts[token] += count  # Accumulate multiplicity
-
-# Print dictionary information
-print(f'Length of dictionary: {len(token_counts)}')
-
-# Calculate the cumulative length of all keys
-total_length = sum(len(key) for key in token_counts)
-print("Cumulative length of all keys in dictionary:", total_length)
-
-# Write results to a JSON file
-output_file = './merge_multiplicities.json'  # Output filename
-with open(output_file, 'w', encoding='utf-8') as f:
-    json.dump(token_counts, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+
+def collect_files(file_paths):
+    """ Collect the paths of all POM files in the given directories """
+    files = []
+    for file_path in file_paths:
+        files.extend([os.path.join(file_path, f) for f in os.listdir(file_path) if is_pom_file(f)])
+    return files
+
+
+def count_tokens(files):
+    """ Map step: accumulate the multiplicities of a list of POM files into one partial counter """
+    token_counts = defaultdict(int)
+    for file in files:
+        # Files are streamed entry by entry, memory only grows with the number of distinct tokens
+        for token, count in iter_pom_counts(file):
+            # Only count if the key length is greater than or equal to 1
+            if len(token) >= 1:
+                token_counts[token] += count  # Accumulate multiplicity
+    return token_counts
+
+
+def merge_counts(pair):
+    """ Reduce step: add the right partial counter into the left one """
+    left, right = pair
+    for token, count in right.items():
+        left[token] += count
+    return left
+
+
+class MisraGriesCounter:
+    """ Bounded-memory heavy-hitter counter (weighted Misra-Gries summary) for merging at multi-genome scale.
+
+    At most 2 * capacity tokens are held. Whenever that is exceeded, the (capacity + 1)-th largest count
+    is subtracted from every token and tokens that drop to zero are forgotten. Every count is therefore
+    a lower bound that undercounts by at most `decrement` <= total / (capacity + 1), and any token with
+    a true multiplicity above that bound is guaranteed to be kept. Summaries of different shards can be
+    merged with the same guarantee.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = defaultdict(int)
+        self.total = 0  # Total multiplicity added
+        self.decrement = 0  # Sum of the subtracted thresholds, the maximum undercount of any token
+
+    def add(self, token, count):
+        self.counts[token] += count
+        self.total += count
+        if len(self.counts) > 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        if len(self.counts) <= self.capacity:
+            return
+        threshold = heapq.nlargest(self.capacity + 1, self.counts.values())[-1]
+        self.decrement += threshold
+        self.counts = defaultdict(
+            int, ((token, count - threshold) for token, count in self.counts.items() if count > threshold)
+        )
+
+    def merge(self, other):
+        for token, count in other.counts.items():
+            self.counts[token] += count
+        self.total += other.total
+        self.decrement += other.decrement
+        self.prune()
+        return self
+
+
+def approximate_count_tokens(files, capacity):
+    """ Map step of the approximate mode: summarize a list of POM files into a MisraGriesCounter """
+    counter = MisraGriesCounter(capacity)
+    for file in files:
+        for token, count in iter_pom_counts(file):
+            # Only count if the key length is greater than or equal to 1
+            if len(token) >= 1:
+                counter.add(token, count)
+    return counter
+
+
+def merge_approximate_counts(pair):
+    """ Reduce step of the approximate mode """
+    left, right = pair
+    return left.merge(right)
+
+
+def parallel_count_tokens(files, num_workers, capacity=None):
+    """ Count tokens with a process pool: each worker reduces a contiguous shard of files, then the
+    partial counters are combined pairwise in a tree. Merging neighbours keeps the token order of a
+    sequential run (first appearance in file order). With a capacity, MisraGriesCounter summaries of
+    bounded size are merged instead of exact counters. """
+    if capacity is None:
+        map_function, reduce_function = count_tokens, merge_counts
+    else:
+        map_function, reduce_function = partial(approximate_count_tokens, capacity=capacity), merge_approximate_counts
+    if num_workers <= 1 or len(files) <= 1:
+        return map_function(files)
+
+    num_shards = min(num_workers, len(files))
+    shard_size = -(-len(files) // num_shards)
+    shards = [files[i:i + shard_size] for i in range(0, len(files), shard_size)]
+    with Pool(num_workers) as pool:
+        partials = pool.map(map_function, shards, chunksize=1)
+        while len(partials) > 1:
+            pairs = [(partials[i], partials[i + 1]) for i in range(0, len(partials) - 1, 2)]
+            merged = pool.map(reduce_function, pairs, chunksize=1)
+            if len(partials) % 2 == 1:
+                merged.append(partials[-1])
+            partials = merged
+    return partials[0]
+
+
+def compare_with_exact(files, capacity, top_k, sample_size, seed=0):
+    """ Count a random sample of the files both exactly and approximately, and report how much the
+    approximate top_k differs from the exact one """
+    sample = random.Random(seed).sample(files, min(sample_size, len(files)))
+    exact = count_tokens(sample)
+    approximate = approximate_count_tokens(sample, capacity)
+    exact_top = [token for token, count in select_top_tokens(exact.items(), top_k)]
+    approximate_top = [token for token, count in select_top_tokens(approximate.counts.items(), top_k)]
+
+    overlap = len(set(exact_top) & set(approximate_top)) / max(len(exact_top), 1)
+    max_error = max((exact[token] - approximate.counts.get(token, 0) for token in exact_top), default=0)
+    print(f"Sample of {len(sample)} files, {len(exact)} distinct tokens: approximate top-{top_k} overlap "
+          f"{overlap:.2%}, largest undercount in the exact top-{top_k} {max_error} "
+          f"(bound {approximate.decrement}, total multiplicity {approximate.total})")
+    return overlap, max_error
+
+
+def file_signature(path):
+    """ (mtime, size) of a POM file, used to notice files that changed after they were merged """
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def write_counts(token_counts, output_file):
+    """ Write the merged multiplicities to a JSON file, atomically """
+    with open(output_file + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(token_counts, f, ensure_ascii=False, indent=4)
+    os.replace(output_file + ".tmp", output_file)
+
+
+def load_merge_state(output_file, state_file):
+    """ Load the persisted aggregate and the {file: signature} record of the files already folded into it.
+    Returns an empty state if either is missing or they do not belong together. """
+    if not (os.path.exists(output_file) and os.path.exists(state_file)):
+        return defaultdict(int), {}
+    with open(state_file, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    # The state records the aggregate it was written with, an interrupted update shows up as a mismatch
+    if state.get("output_signature") != file_signature(output_file):
+        print(f"{output_file} does not match {state_file}, rebuilding from scratch")
+        return defaultdict(int), {}
+    with open(output_file, 'r', encoding='utf-8') as f:
+        token_counts = defaultdict(int, json.load(f))
+    return token_counts, state["files"]
+
+
+def save_merge_state(output_file, state_file, merged_files):
+    with open(state_file + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({"output_signature": file_signature(output_file), "files": merged_files}, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def incremental_merge(file_paths, output_file, state_file, num_workers):
+    """ Fold only the POM files that are not in the persisted aggregate yet into it.
+    If a merged file changed or disappeared, the aggregate is rebuilt from all files. """
+    files = collect_files(file_paths)
+    signatures = {file: file_signature(file) for file in files}
+    token_counts, merged_files = load_merge_state(output_file, state_file)
+    if any(signatures.get(file) != signature for file, signature in merged_files.items()):
+        print("Some merged POM files changed or disappeared, rebuilding from scratch")
+        token_counts, merged_files = defaultdict(int), {}
+
+    new_files = [file for file in files if file not in merged_files]
+    if new_files or not os.path.exists(output_file):
+        merge_counts((token_counts, parallel_count_tokens(new_files, num_workers)))
+        write_counts(token_counts, output_file)
+        merged_files.update((file, signatures[file]) for file in new_files)
+        save_merge_state(output_file, state_file, merged_files)
+    print(f"Merged {len(new_files)} new files, {len(merged_files)} files in total")
+    return token_counts, len(new_files)
+
+
+def print_summary(token_counts):
+    # Print dictionary information
+    print(f'Length of dictionary: {len(token_counts)}')
+
+    # Calculate the cumulative length of all keys
+    total_length = sum(len(key) for key in token_counts)
+    print("Cumulative length of all keys in dictionary:", total_length)
+
+
+if __name__ == "__main__":
+    # Define file paths
+    file_paths = [
+        './hg19_json_file_1000000',
+    ]
+    output_file = './merge_multiplicities.json'  # Output filename
+    num_workers = os.cpu_count() or 1  # Processes reading POM files in parallel
+    # Incremental mode: remember which POM files are already merged (name, mtime and size in
+    # state_file) and only fold in the new ones, so the merge can be rerun while step 2 is running
+    incremental = True
+    state_file = output_file + '.state'
+    # Seconds between incremental updates in watch mode (0 merges once and exits)
+    watch_interval = 0
+
+    # Approximate mode: bounded-memory heavy-hitter counting (Misra-Gries) for pan-genome and multi-species
+    # runs, every token's count is undercounted by at most epsilon * total multiplicity
+    approximate = False
+    epsilon = 1e-6
+    compare_sample_size = 50  # Files counted both ways to report the top-K difference (0 to skip)
+    compare_top_k = 1000
+
+    if approximate:
+        capacity = math.ceil(1 / epsilon)
+        files = collect_files(file_paths)
+        if compare_sample_size > 0:
+            compare_with_exact(files, capacity, compare_top_k, compare_sample_size)
+        counter = parallel_count_tokens(files, num_workers, capacity)
+        counter.prune()
+        print(f"Approximate counts: capacity {capacity}, counts undercount by at most {counter.decrement} "
+              f"of a total multiplicity of {counter.total}")
+        print_summary(counter.counts)
+        write_counts(counter.counts, output_file)
+    elif incremental:
+        while True:
+            token_counts, num_new_files = incremental_merge(file_paths, output_file, state_file, num_workers)
+            if num_new_files:
+                print_summary(token_counts)
+            if watch_interval <= 0:
+                break
+            time.sleep(watch_interval)
+    else:
+        # Collect all POM file paths
+        files = collect_files(file_paths)
+
+        # Read files and accumulate multiplicities
+        token_counts = parallel_count_tokens(files, num_workers)
+        print_summary(token_counts)
+
+        # Write results to a JSON file
+        write_counts(token_counts, output_file)
\ No newline at end of file
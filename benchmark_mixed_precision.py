@@ -0,0 +1,108 @@
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import BertConfig, BertForMaskedLM
+
+from LPT_pretrain import autocast_context
+
+
+def random_batch(vocab_size, batch_size, seq_length, mlm_probability, generator):
+    """
+    Random token IDs with MLM labels on a mlm_probability share of the positions (special IDs 0-4 excluded).
+    """
+    inputs = torch.randint(5, vocab_size, (batch_size, seq_length), generator=generator)
+    labels = inputs.clone()
+    masked = torch.rand(inputs.shape, generator=generator) < mlm_probability
+    labels[~masked] = -100
+    inputs[masked] = 4
+    return inputs, labels
+
+
+def benchmark(precision, config, args, device):
+    """
+    Train a fresh model for args.steps optimizer steps in the given precision, the same way LPT_pretrain.py does.
+    Return the mean step time (after warmup), the peak CUDA memory and the last loss.
+    """
+    torch.manual_seed(args.seed)
+    run_args = SimpleNamespace(device=device, fp16=precision == "fp16", bf16=precision == "bf16")
+    model = BertForMaskedLM(config).to(device)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-5)
+    scaler = torch.amp.GradScaler(device.type, enabled=run_args.fp16)
+    generator = torch.Generator().manual_seed(args.seed)
+    batches = [
+        random_batch(config.vocab_size, args.batch_size, args.seq_length, 0.15, generator)
+        for _ in range(args.gradient_accumulation_steps)
+    ]
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    times = []
+    loss = None
+    for step in range(args.warmup_steps + args.steps):
+        start = time.perf_counter()
+        for inputs, labels in batches:
+            inputs, labels = inputs.to(device), labels.to(device)
+            with autocast_context(run_args):
+                loss = model(input_ids=inputs, labels=labels)[0] / args.gradient_accumulation_steps
+            scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        if step >= args.warmup_steps:
+            times.append(time.perf_counter() - start)
+
+    peak_memory = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else None
+    return sum(times) / len(times), peak_memory, loss.item() * args.gradient_accumulation_steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fp32, fp16 and bf16 training step time and memory.")
+    parser.add_argument("--config_name", type=str, default=None, help="BERT config file, e.g. ./bert_config.json.")
+    parser.add_argument("--batch_size", type=int, default=16, help="Sequences per micro-batch.")
+    parser.add_argument("--seq_length", type=int, default=512, help="Tokens per sequence.")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=2, help="Micro-batches per step.")
+    parser.add_argument("--steps", type=int, default=10, help="Number of timed optimizer steps.")
+    parser.add_argument("--warmup_steps", type=int, default=2, help="Untimed steps before the timed ones.")
+    parser.add_argument(
+        "--precisions", nargs="+", default=["fp32", "fp16", "bf16"], choices=["fp32", "fp16", "bf16"],
+        help="Precisions to compare."
+    )
+    parser.add_argument("--no_cuda", action="store_true", help="Benchmark on the CPU even if CUDA is available.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    config = BertConfig.from_json_file(args.config_name) if args.config_name else BertConfig(vocab_size=1000)
+    args.seq_length = min(args.seq_length, config.max_position_embeddings)
+    print(f"device {device}, {config.num_hidden_layers} layers, hidden {config.hidden_size}, "
+          f"batch {args.batch_size} x {args.seq_length} tokens x {args.gradient_accumulation_steps} accumulation steps")
+
+    results = {}
+    for precision in args.precisions:
+        if precision == "bf16" and device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            print(f"{precision}: not supported on this GPU, skipped")
+            continue
+        results[precision] = benchmark(precision, config, args, device)
+
+    baseline = results.get("fp32")
+    for precision, (step_time, peak_memory, loss) in results.items():
+        line = f"{precision}: {step_time * 1000:.1f} ms/step"
+        if baseline is not None:
+            line += f" ({baseline[0] / step_time:.2f}x fp32)"
+        if peak_memory is not None:
+            line += f", peak memory {peak_memory / 2 ** 30:.2f} GiB"
+            if baseline is not None:
+                line += f" ({peak_memory / baseline[1]:.2f}x fp32)"
+        line += f", last loss {loss:.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import random
+import time
+
+from Ladderpath_multiprocess_DNASequence import sequence_generator, valid_bases
+
+
+def legacy_sequence_generator(sequences, max_length):
+    """
+    Reference implementation: the per-character loop sequence_generator used before split_valid_fragments.
+    """
+    current_length = 0
+    current_sequences = []
+    for sequence in sequences:
+        sequence = sequence.upper()
+        fragments = []
+        fragment = []
+        for char in sequence:
+            if char in valid_bases:
+                fragment.append(char)
+            else:
+                if fragment:
+                    fragments.append("".join(fragment))
+                    fragment = []
+        if fragment:
+            fragments.append("".join(fragment))
+
+        for frag in fragments:
+            frag_length = len(frag)
+            if frag_length <= 1:
+                continue
+            if frag_length > max_length:
+                split_fragments = [frag[i:i + max_length] for i in range(0, len(frag), max_length)]
+                for split_frag in split_fragments:
+                    if current_length + len(split_frag) > max_length:
+                        yield current_sequences
+                        current_sequences = []
+                        current_length = 0
+                    current_sequences.append(split_frag)
+                    current_length += len(split_frag)
+            else:
+                if current_length + frag_length > max_length:
+                    yield current_sequences
+                    current_sequences = []
+                    current_length = 0
+                current_sequences.append(frag)
+                current_length += frag_length
+
+    if current_sequences:
+        yield current_sequences
+
+
+def random_sequences(num_sequences, mean_length, seed):
+    """
+    Generate soft-masked, genome-like sequences with occasional N runs and IUPAC codes.
+    """
+    rng = random.Random(seed)
+    sequences = []
+    for _ in range(num_sequences):
+        length = max(1, int(rng.expovariate(1 / mean_length)))
+        bases = rng.choices("ACGTacgt", k=length)
+        for _ in range(length // 5000):
+            position = rng.randrange(length)
+            run = rng.randint(1, 200)
+            bases[position:position + run] = rng.choice(["N", "n", "R", "Y"]) * len(bases[position:position + run])
+        sequences.append("".join(bases))
+    return sequences
+
+
+def benchmark(generator, sequences, max_length, repeat):
+    """
+    Return the best wall-clock time over repeat runs and the produced batches.
+    """
+    best = float("inf")
+    batches = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        batches = list(generator(sequences, max_length))
+        best = min(best, time.perf_counter() - start)
+    return best, batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sequence_generator with the legacy per-character loop.")
+    parser.add_argument("--num_sequences", type=int, default=2000, help="Number of random sequences.")
+    parser.add_argument("--mean_length", type=int, default=20000, help="Mean sequence length.")
+    parser.add_argument("--max_length", type=int, default=1000000, help="Max total characters per batch.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs, the best one is reported.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    args = parser.parse_args()
+
+    sequences = random_sequences(args.num_sequences, args.mean_length, args.seed)
+    total_length = sum(len(sequence) for sequence in sequences)
+    print(f"{len(sequences)} sequences, {total_length / 1e6:.1f} Mbp, max_length {args.max_length}")
+
+    legacy_time, legacy_batches = benchmark(legacy_sequence_generator, sequences, args.max_length, args.repeat)
+    fast_time, fast_batches = benchmark(sequence_generator, sequences, args.max_length, args.repeat)
+    if fast_batches != legacy_batches:
+        raise AssertionError("sequence_generator batches differ from the legacy implementation")
+
+    print(f"Batches: {len(fast_batches)} (identical)")
+    print(f"legacy loop:        {legacy_time:.3f} s ({total_length / legacy_time / 1e6:.1f} Mbp/s)")
+    print(f"sequence_generator: {fast_time:.3f} s ({total_length / fast_time / 1e6:.1f} Mbp/s)")
+    print(f"Speedup: {legacy_time / fast_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,68 @@
-import json
+import argparse
+import heapq
 import os
-from collections import defaultdict
-
-# Define file paths
-file_paths = [
-    './hg19_json_file'
-]
-
-# Collect all JSON file paths
-files = []
-for file_path in file_paths:
-    files.extend([os.path.join(file_path, f) for f in os.listdir(file_path) if f.endswith('.json')])
-
-# Use defaultdict to accumulate multiplicities
-token_counts = defaultdict(int)
-
-# Read files and accumulate multiplicities
-for file in files:
-    with open(file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        for layer in data.values():  # Iterate through each layer
-            for token, count in layer.items():
-                # Only count if the key length is greater than or equal to 1
-                if len(token) >= 1:
-                    token_counts[token] += count  # Accumulate multiplicity
-
-# Print dictionary information
-print(f'Length of dictionary: {len(token_counts)}')
-
-# Calculate the cumulative length of all keys
-total_length = sum(len(key) for key in token_counts)
-print("Cumulative length of all keys in dictionary:", total_length)
-
-# Write results to a JSON file
-output_file = './token_chongshu_total.json'  # Output filename
-with open(output_file, 'w', encoding='utf-8') as f:
-    json.dump(token_counts, f, ensure_ascii=False, indent=4)
-
-# Sort items by frequency in descending order
-# (Note: Using 'token_counts' from above)
-sorted_items = sorted(token_counts.items(), key=lambda item: item[1], reverse=True)
-
-# Extract the top K keys (e.g., 1000)
-top_k_keys = [key for key, value in sorted_items[:1000]]
-
-# Write vocabulary to file
-with open('./vocab.txt', 'w') as f:
-    for key in top_k_keys:
-        f.write(key + '\n')
-
-print("Finished writing top keys to vocab.txt")
\ No newline at end of file
+from pom_format import iter_merged_counts
+
+# BERT special tokens, written first so they get the IDs 0-4 that BertTokenizer and tokenize_sequences.py expect
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+def select_top_tokens(token_counts, top_k, min_count=1):
+    """ Select the top_k most frequent tokens with a bounded heap in O(n log K), without sorting every token.
+    Ties keep the order of the input, like a stable sort by decreasing frequency. """
+    candidates = ((token, count) for token, count in token_counts if count >= min_count)
+    return heapq.nlargest(top_k, candidates, key=lambda item: item[1])
+
+
+def vocab_file_name(output_file, top_k, multiple):
+    """ ./vocab.txt for a single size, ./vocab_{K}.txt for each size of a sweep """
+    if not multiple:
+        return output_file
+    root, extension = os.path.splitext(output_file)
+    return f"{root}_{top_k}{extension}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build vocab.txt from the merged Ladderpath multiplicities.")
+    parser.add_argument(
+        "--input", default="./merge_multiplicities.json", type=str,
+        help="Merged multiplicities written by Merge_the_multiplicities.py."
+    )
+    parser.add_argument(
+        "--output", default="./vocab.txt", type=str,
+        help="Vocabulary file. With several --top-k values, one file vocab_{K}.txt is written per size."
+    )
+    parser.add_argument(
+        "--top-k", "--top_k", dest="top_k", default=[1000], type=int, nargs="+",
+        help="Number of most frequent tokens to keep. Several values build several vocabularies in one pass."
+    )
+    parser.add_argument(
+        "--min-count", "--min_count", dest="min_count", default=1, type=int,
+        help="Ignore tokens whose multiplicity is below this value."
+    )
+    parser.add_argument(
+        "--no-special-tokens", "--no_special_tokens", dest="special_tokens", action="store_false",
+        help="Write only the Ladderpath tokens, without the leading [PAD] [UNK] [CLS] [SEP] [MASK] lines."
+    )
+    args = parser.parse_args()
+
+    # One scan selects the largest requested size, every smaller vocabulary is a prefix of it
+    top_items = select_top_tokens(iter_merged_counts(args.input), max(args.top_k), args.min_count)
+    print(f"Selected {len(top_items)} tokens with multiplicity >= {args.min_count}")
+
+    multiple = len(args.top_k) > 1
+    for top_k in sorted(set(args.top_k)):
+        vocab_file = vocab_file_name(args.output, top_k, multiple)
+        # Write vocabulary to file
+        with open(vocab_file, 'w') as f:
+            if args.special_tokens:
+                for token in SPECIAL_TOKENS:
+                    f.write(token + '\n')
+            for key, value in top_items[:top_k]:
+                f.write(key + '\n')
+        special = f" after the {len(SPECIAL_TOKENS)} special tokens" if args.special_tokens else ""
+        print(f"Finished writing top {min(top_k, len(top_items))} keys{special} to {vocab_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import gzip
+import json
+import re
+import struct
+from array import array
+
+# Compact binary POM file (.pom, or .pom.gz when gzip-compressed), all integers little-endian:
+#   magic b"POMB\x01"
+#   uint64 number of tokens, uint64 token table size,
+#   token table: the distinct tokens of all layers, utf-8, joined by "\n"
+#   uint32 number of layers, then per layer:
+#       uint32 name size, name (utf-8)
+#       uint64 number of entries, int32[n] token ids into the token table, int64[n] multiplicities
+POM_MAGIC = b"POMB\x01"
+POM_EXTENSIONS = (".json", ".pom", ".pom.gz")
+
+# One "token": multiplicity entry per line, as written by json.dump(pom, f, indent=4)
+_JSON_ENTRY = re.compile(r'^\s*("(?:[^"\\]|\\.)*")\s*:\s*(-?\d+),?\s*$')
+
+
+def _open(path, mode, compress=None):
+    if compress is None:
+        compress = path.endswith(".gz")
+    return gzip.open(path, mode, compresslevel=3) if compress else open(path, mode)
+
+
+def _little_endian(values):
+    if struct.pack("=I", 1) != struct.pack("<I", 1):
+        values.byteswap()
+    return values
+
+
+def write_pom(pom, path, compress=None):
+    """ Write a POM dictionary {layer: {token: multiplicity}} in the compact binary format, gzip-compressed
+    if compress is set (by default when path ends with .gz) """
+    token_ids = {}
+    layers = []
+    for layer, counts in pom.items():
+        ids = array("i")
+        multiplicities = array("q")
+        for token, count in counts.items():
+            ids.append(token_ids.setdefault(token, len(token_ids)))
+            multiplicities.append(count)
+        layers.append((str(layer), ids, multiplicities))
+
+    token_table = "\n".join(token_ids).encode("utf-8")
+    with _open(path, "wb", compress) as f:
+        f.write(POM_MAGIC)
+        f.write(struct.pack("<QQ", len(token_ids), len(token_table)))
+        f.write(token_table)
+        f.write(struct.pack("<I", len(layers)))
+        for name, ids, multiplicities in layers:
+            name = name.encode("utf-8")
+            f.write(struct.pack("<I", len(name)))
+            f.write(name)
+            f.write(struct.pack("<Q", len(ids)))
+            f.write(_little_endian(ids).tobytes())
+            f.write(_little_endian(multiplicities).tobytes())
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError(f"Truncated POM file {getattr(f, 'name', '')}")
+    return data
+
+
+def iter_pom_layers(path):
+    """ Yield (layer, tokens, multiplicities) from a binary POM file, one layer at a time """
+    with _open(path, "rb") as f:
+        if f.read(len(POM_MAGIC)) != POM_MAGIC:
+            raise ValueError(f"{path} is not a binary POM file")
+        num_tokens, table_size = struct.unpack("<QQ", _read_exact(f, 16))
+        table = _read_exact(f, table_size).decode("utf-8")
+        tokens = table.split("\n") if num_tokens else []
+        (num_layers,) = struct.unpack("<I", _read_exact(f, 4))
+        for _ in range(num_layers):
+            (name_size,) = struct.unpack("<I", _read_exact(f, 4))
+            name = _read_exact(f, name_size).decode("utf-8")
+            (num_entries,) = struct.unpack("<Q", _read_exact(f, 8))
+            ids = array("i")
+            ids.frombytes(_read_exact(f, 4 * num_entries))
+            multiplicities = array("q")
+            multiplicities.frombytes(_read_exact(f, 8 * num_entries))
+            yield name, [tokens[i] for i in _little_endian(ids)], _little_endian(multiplicities)
+
+
+def _iter_json_pom_counts(path):
+    """ Stream (token, multiplicity) pairs from an indented POM JSON file line by line """
+    with open(path, 'r', encoding='utf-8') as f:
+        first_line = f.readline()
+        if first_line.strip() != "{":
+            # Not the one-entry-per-line layout, fall back to loading the whole file
+            f.seek(0)
+            for layer in json.load(f).values():
+                yield from layer.items()
+            return
+        depth = 1
+        for line in f:
+            stripped = line.strip()
+            if stripped.endswith("{"):
+                depth += 1
+            elif stripped.startswith("}"):
+                depth -= 1
+            elif depth == 2:
+                match = _JSON_ENTRY.match(line)
+                if match is None:
+                    raise ValueError(f"Unexpected line in POM file {path}: {line!r}")
+                yield json.loads(match.group(1)), int(match.group(2))
+
+
+def iter_merged_counts(path):
+    """ Stream the (token, multiplicity) pairs of merge_multiplicities.json (a flat, indented JSON object) """
+    with open(path, 'r', encoding='utf-8') as f:
+        first_line = f.readline()
+        if first_line.strip() != "{":
+            f.seek(0)
+            yield from json.load(f).items()
+            return
+        for line in f:
+            if line.strip() == "}":
+                break
+            match = _JSON_ENTRY.match(line)
+            if match is None:
+                raise ValueError(f"Unexpected line in {path}: {line!r}")
+            yield json.loads(match.group(1)), int(match.group(2))
+
+
+def iter_pom_counts(path):
+    """ Stream the (token, multiplicity) pairs of every layer of a POM file, without building the whole dictionary """
+    if path.endswith(".json"):
+        yield from _iter_json_pom_counts(path)
+        return
+    for name, tokens, multiplicities in iter_pom_layers(path):
+        yield from zip(tokens, multiplicities)
+
+
+def read_pom(path):
+    """ Read a POM file (indented JSON or binary .pom/.pom.gz) into {layer: {token: multiplicity}} """
+    if path.endswith(".json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {name: dict(zip(tokens, multiplicities)) for name, tokens, multiplicities in iter_pom_layers(path)}
+
+
+def is_pom_file(file_name):
+    """ Whether a file name is a POM output of Ladderpath_multiprocess_DNASequence.py """
+    return file_name.endswith(POM_EXTENSIONS)
@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import pandas as pd
+from store_format import header_path, is_store, read_header, store_prefix, write_header
+
+# Files making up a sequence store with prefix P:
+#   P.json      header (format, version, packing, number of sequences), see store_format.py
+#   P.seq       sequence blob, plain bytes or 2-bit packed (4 bases per byte, A=0 C=1 G=2 T=3)
+#   P.meta.csv  one row per sequence: Gene_ID, Strand, Start, End, Offset, Length, MaskOffset, MaskCount
+#   P.mask.npy  2-bit packing only: [start, end) runs of non-ACGT bases, relative to their sequence
+STORE_FORMAT = "sequence store"
+STORE_VERSION = 1
+PACKINGS = ("bytes", "2bit")
+
+_BASE_LETTERS = np.frombuffer(b"ACGT", dtype=np.uint8)
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _letter in enumerate(b"ACGT"):
+    _BASE_CODES[_letter] = _code
+    _BASE_CODES[ord(chr(_letter).lower())] = _code
+
+
+def store_paths(prefix):
+    """ Return the header, blob, metadata and mask paths of a sequence store """
+    return header_path(prefix), prefix + ".seq", prefix + ".meta.csv", prefix + ".mask.npy"
+
+
+def is_sequence_store(path):
+    """ Check whether path is the prefix (or header file) of a sequence store """
+    return is_store(path, STORE_FORMAT)
+
+
+def pack_2bit(sequence):
+    """ Pack a sequence into 2-bit codes, returning (packed bytes, [start, end) runs of non-ACGT bases) """
+    raw = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    codes = _BASE_CODES[raw]
+    invalid = codes == 255
+
+    # Runs of non-ACGT bases are stored separately and packed as A
+    edges = np.diff(np.concatenate(([0], invalid.view(np.int8), [0])))
+    mask_runs = np.stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)], axis=1)
+    codes[invalid] = 0
+
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    padded = padded.reshape(-1, 4)
+    packed = (padded[:, 0] << 6) | (padded[:, 1] << 4) | (padded[:, 2] << 2) | padded[:, 3]
+    return packed.astype(np.uint8).tobytes(), mask_runs
+
+
+def unpack_2bit(packed, length, mask_runs=None):
+    """ Unpack 2-bit codes into an uppercase sequence, writing N over the masked runs """
+    packed = np.asarray(packed, dtype=np.uint8)
+    codes = np.empty((len(packed), 4), dtype=np.uint8)
+    codes[:, 0] = packed >> 6
+    codes[:, 1] = (packed >> 4) & 3
+    codes[:, 2] = (packed >> 2) & 3
+    codes[:, 3] = packed & 3
+    letters = _BASE_LETTERS[codes.reshape(-1)[:length]]
+    if mask_runs is not None:
+        for start, end in mask_runs:
+            letters[start:end] = ord("N")
+    return letters.tobytes().decode()
+
+
+def write_sequence_store(gene_sequences, prefix, packing="2bit"):
+    """ Save {key: {sequence, strand, start, end}} as a sequence blob plus an offsets/metadata table """
+    write_sequence_store_rows(
+        ((gene_id, info["sequence"], info["strand"], info["start"], info["end"]) for gene_id, info in gene_sequences.items()),
+        prefix, packing
+    )
+
+
+def write_sequence_store_rows(sequence_rows, prefix, packing="2bit"):
+    """ Save an iterable of (key, sequence, strand, start, end) rows as a sequence store, one sequence at a time
+
+    Every sequence goes to the blob as soon as it arrives, only the metadata table is kept in memory. """
+    if packing not in PACKINGS:
+        raise ValueError(f"Unknown packing '{packing}', expected one of {PACKINGS}")
+    _, blob_path, meta_path, mask_path = store_paths(prefix)
+
+    rows = []
+    mask_runs = []
+    mask_offset = 0
+    offset = 0
+    with open(blob_path, 'wb') as blob:
+        for gene_id, sequence, strand, start, end in sequence_rows:
+            if packing == "2bit":
+                data, runs = pack_2bit(sequence)
+                mask_runs.append(runs)
+                mask_count = len(runs)
+            else:
+                data = sequence.encode()
+                mask_count = 0
+            blob.write(data)
+            rows.append({
+                "Gene_ID": gene_id,
+                "Strand": strand,
+                "Start": start,
+                "End": end,
+                "Offset": offset,
+                "Length": len(sequence),
+                "MaskOffset": mask_offset,
+                "MaskCount": mask_count
+            })
+            offset += len(data)
+            mask_offset += mask_count
+
+    columns = ["Gene_ID", "Strand", "Start", "End", "Offset", "Length", "MaskOffset", "MaskCount"]
+    pd.DataFrame(rows, columns=columns).to_csv(meta_path, index=False)
+    if packing == "2bit":
+        runs = np.concatenate(mask_runs) if mask_runs else np.empty((0, 2), dtype=np.int64)
+        np.save(mask_path, runs.astype(np.int64))
+    write_header(prefix, STORE_FORMAT, STORE_VERSION, packing=packing, num_sequences=len(rows))
+
+
+class SequenceStore:
+    """ Read-only, memory-mapped view of a sequence store written by write_sequence_store """
+
+    def __init__(self, prefix):
+        prefix = store_prefix(prefix)
+        _, blob_path, meta_path, mask_path = store_paths(prefix)
+        header = read_header(prefix, STORE_FORMAT, STORE_VERSION)
+        self.packing = header["packing"]
+        self.meta = pd.read_csv(meta_path)
+        self.offsets = self.meta["Offset"].to_numpy()
+        self.lengths = self.meta["Length"].to_numpy()
+        self.mask_offsets = self.meta["MaskOffset"].to_numpy()
+        self.mask_counts = self.meta["MaskCount"].to_numpy()
+
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.empty(0, dtype=np.uint8)
+        self.mask = np.load(mask_path, mmap_mode='r') if self.packing == "2bit" else None
+
+    def __len__(self):
+        return len(self.meta)
+
+    def raw(self, i):
+        """ Zero-copy view of the stored bytes of sequence i (plain bytes, or 2-bit packed codes) """
+        length = self.lengths[i]
+        size = length if self.packing == "bytes" else (length + 3) // 4
+        return self.blob[self.offsets[i]:self.offsets[i] + size]
+
+    def __getitem__(self, i):
+        if self.packing == "bytes":
+            return self.raw(i).tobytes().decode()
+        mask_runs = self.mask[self.mask_offsets[i]:self.mask_offsets[i] + self.mask_counts[i]]
+        return unpack_2bit(self.raw(i), self.lengths[i], mask_runs)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -1,5 +1,15 @@
+import os
+from collections import deque
+from multiprocessing import Pool
 from Bio import SeqIO
+import numpy as np
 import pandas as pd
+from sequence_store import write_sequence_store, write_sequence_store_rows
+
+# Sequences buffered before they are appended to the output CSV file (a larger single region is written on its own)
+WRITE_BUFFER_BASES = 1 << 24
+# Bases per task of the parallel extraction; 2 * num_workers tasks are in flight at most
+SHARD_BASES = 1 << 24
 
 
 def parse_fasta(fasta_file):
@@ -10,183 +20,405 @@ def parse_fasta(fasta_file):
     return sequences
 
 
+def build_fasta_index(fasta_file, index_file=None):
+    """ Build a samtools-style .fai index (name, length, offset, linebases, linewidth) for the FASTA file """
+    if index_file is None:
+        index_file = fasta_file + ".fai"
+
+    entries = []
+    with open(fasta_file, 'rb') as f:
+        name = None
+        length = offset = linebases = linewidth = 0
+        short_line_seen = False
+        position = 0
+        for line in f:
+            line_length = len(line)
+            if line.startswith(b">"):
+                if name is not None:
+                    entries.append((name, length, offset, linebases, linewidth))
+                name = line[1:].split()[0].decode()
+                length = linebases = linewidth = 0
+                offset = position + line_length
+                short_line_seen = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases == 0:
+                    position += line_length
+                    continue
+                if linebases == 0:
+                    linebases, linewidth = bases, line_length
+                elif short_line_seen or bases > linebases:
+                    # Only the last line of a record may be shorter than the others
+                    raise ValueError(f"Different line length in sequence '{name}', the FASTA file cannot be indexed")
+                elif bases < linebases:
+                    short_line_seen = True
+                length += bases
+            position += line_length
+        if name is not None:
+            entries.append((name, length, offset, linebases, linewidth))
+
+    with open(index_file, 'w') as f:
+        for entry in entries:
+            f.write("\t".join(str(value) for value in entry) + "\n")
+    return index_file
+
+
+class IndexedSequence:
+    """ A single chromosome backed by a .fai index, slices are read straight from disk """
+
+    def __init__(self, fasta_index, name, length, offset, linebases, linewidth):
+        self.fasta_index = fasta_index
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.linebases = linebases
+        self.linewidth = linewidth
+
+    def __len__(self):
+        return self.length
+
+    def _byte_offset(self, position):
+        """ Convert a 0-based base position into a byte offset in the FASTA file """
+        return self.offset + (position // self.linebases) * self.linewidth + position % self.linebases
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("IndexedSequence only supports slicing")
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError("IndexedSequence only supports contiguous slices")
+        if stop <= start:
+            return ""
+
+        # Read only the bytes that cover [start, stop) and drop the line breaks
+        begin = self._byte_offset(start)
+        end = self._byte_offset(stop - 1) + 1
+        handle = self.fasta_index.handle()
+        handle.seek(begin)
+        chunk = handle.read(end - begin)
+        return chunk.translate(None, b"\r\n").decode()
+
+    def __str__(self):
+        return self[:]
+
+
+class FastaIndex:
+    """ Dictionary-like view {chromosome: IndexedSequence} over a FASTA file, built from (or reusing) its .fai index """
+
+    def __init__(self, fasta_file, index_file=None):
+        self.fasta_file = fasta_file
+        if index_file is None:
+            index_file = fasta_file + ".fai"
+        # Rebuild the index if it is missing or older than the FASTA file
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(fasta_file):
+            print(f"Building FASTA index {index_file}")
+            build_fasta_index(fasta_file, index_file)
+
+        self.entries = {}
+        with open(index_file, 'r') as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 5:
+                    continue
+                self.entries[fields[0]] = tuple(int(value) for value in fields[1:5])
+        self._handle = None
+
+    def handle(self):
+        """ Lazily open the FASTA file, so every process gets its own file handle """
+        if self._handle is None:
+            self._handle = open(self.fasta_file, 'rb')
+        return self._handle
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handle"] = None
+        return state
+
+    def __contains__(self, seqid):
+        return seqid in self.entries
+
+    def __getitem__(self, seqid):
+        return IndexedSequence(self, seqid, *self.entries[seqid])
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+
+def parse_fasta_indexed(fasta_file):
+    """ Open the FASTA file through a .fai index instead of loading every chromosome into memory """
+    return FastaIndex(fasta_file)
+
+
+GENE_COLUMNS = ["gene_id", "seqid", "start", "end", "strand"]
+
+
+def parse_csv_table(csv_file):
+    """ Parse the CSV file into a DataFrame with one row per gene ID (gene_id, seqid, start, end, strand) """
+    df = pd.read_csv(csv_file, usecols=GENE_COLUMNS)
+    # Keep the order in which each gene_id first appears, with the location of its last record
+    last_records = df.drop_duplicates("gene_id", keep="last").set_index("gene_id")
+    first_order = df["gene_id"].drop_duplicates(keep="first").to_numpy()
+    return last_records.loc[first_order].reset_index()[GENE_COLUMNS]
+
+
 def parse_csv(csv_file):
     """ Parse the CSV file and return a dictionary where keys are gene IDs and values are gene location information """
-    genes = {}
-    df = pd.read_csv(csv_file)
-
-    for _, row in df.iterrows():
-        gene_id = row['gene_id']
-        seqid = row['seqid']
-        start = row['start']
-        end = row['end']
-        strand = row['strand']
-        # if strand == '+':
-        # Process only records with a gene_id, and extract only the first row for the same gene_id
-        genes[gene_id] = {
-                "seqid": seqid,
-                "start": start,
-                "end": end,
-                "strand": strand
-            }
-
-    return genes
-
-def extract_gene_sequences(fasta_sequences, gff_genes):
-    """ Extract DNA sequences of genes from the FASTA file based on location info, handling overlapping genes """
-    gene_sequences = {}
-    chromosome_boundaries = {}
-
-    # Convert dictionary to list for indexing
-    gene_list = list(gff_genes.items())
-
-    for i, (gene_id, gene_info) in enumerate(gene_list):
-        seqid = gene_info["seqid"]
-        start = gene_info["start"]
-        end = gene_info["end"]
-        strand = gene_info["strand"]
-
-        if seqid not in fasta_sequences:
-            continue  # Skip genes if the chromosome is not in the FASTA file
-
-        chromosome_seq = fasta_sequences[seqid]
-
-        # Check if there is a next gene
-        if i < len(gene_list) - 1:
-            next_gene_id, next_gene_info = gene_list[i + 1]
-            next_seqid = next_gene_info['seqid']
-
-            # Check if on the same chromosome
-            if seqid == next_seqid:
-                # Check condition
-                if start < next_gene_info['end']:
-                    # Adjust start position
-                    start = next_gene_info['end'] + 1
-
-        # Ensure start and end positions are within valid range
-        if start < 1:
-            start = 1
-        if end > len(chromosome_seq):
-            end = len(chromosome_seq)
-
-        # Extract gene sequence
-        gene_seq = chromosome_seq[start - 1:end]  # GFF files are 1-based, Python is 0-based
-
-        gene_sequences[f"{seqid}_{gene_id}"] = {
-            "sequence": str(gene_seq),
+    gene_table = parse_csv_table(csv_file)
+    return {
+        gene_id: {"seqid": seqid, "start": start, "end": end, "strand": strand}
+        for gene_id, seqid, start, end, strand in zip(*(gene_table[column] for column in GENE_COLUMNS))
+    }
+
+
+def genes_to_table(gff_genes):
+    """ Convert the {gene_id: location} dictionary returned by parse_csv into a gene DataFrame """
+    if isinstance(gff_genes, pd.DataFrame):
+        return gff_genes
+    gene_table = pd.DataFrame.from_dict(gff_genes, orient="index", columns=GENE_COLUMNS[1:])
+    gene_table.insert(0, "gene_id", gene_table.index)
+    return gene_table.reset_index(drop=True)
+
+
+def chromosome_lengths(fasta_sequences, seqids):
+    """ Return a Series mapping each seqid present in the FASTA file to its chromosome length """
+    present = [seqid for seqid in pd.unique(seqids) if seqid in fasta_sequences]
+    return pd.Series({seqid: len(fasta_sequences[seqid]) for seqid in present}, dtype="int64")
+
+
+def gene_intervals(gene_table, lengths):
+    """ Compute overlap-adjusted gene intervals and chromosome-end non-coding intervals
+
+    Returns a DataFrame (key, seqid, start, end, strand) in the order extract_gene_sequences writes them.
+    """
+    seqids = gene_table["seqid"]
+    starts = gene_table["start"]
+    ends = gene_table["end"]
+
+    # A gene that starts before the end of the next gene on the same chromosome starts right after it
+    next_seqids = seqids.shift(-1)
+    next_ends = ends.shift(-1, fill_value=0)
+    overlaps = (seqids == next_seqids) & (starts < next_ends)
+    starts = starts.where(~overlaps, next_ends + 1).clip(lower=1)
+
+    # Skip genes if the chromosome is not in the FASTA file
+    in_fasta = seqids.isin(lengths.index)
+    genes = pd.DataFrame({
+        "seqid": seqids[in_fasta],
+        "gene_id": gene_table["gene_id"][in_fasta],
+        "start": starts[in_fasta],
+        "end": ends[in_fasta],
+        "strand": gene_table["strand"][in_fasta],
+    })
+    genes["end"] = genes["end"].where(genes["end"] <= genes["seqid"].map(lengths), genes["seqid"].map(lengths))
+    genes["key"] = genes["seqid"].astype(str) + "_" + genes["gene_id"].astype(str)
+
+    # Non-coding regions at the beginning and end of every chromosome, in order of first appearance
+    boundaries = genes.groupby("seqid", sort=False).agg(start=("start", "min"), end=("end", "max"))
+    boundaries["length"] = lengths.loc[boundaries.index].to_numpy()
+    boundaries = boundaries.reset_index()
+    boundaries["order"] = range(len(boundaries))
+
+    head = boundaries[boundaries["start"] > 1]
+    head = pd.DataFrame({
+        "key": head["seqid"].astype(str) + "_start_noncoding",
+        "seqid": head["seqid"],
+        "start": 1,
+        "end": head["start"] - 1,
+        "strand": "+",
+        "order": head["order"],
+        "part": 0,
+    })
+    tail = boundaries[boundaries["end"] < boundaries["length"]]
+    tail = pd.DataFrame({
+        "key": tail["seqid"].astype(str) + "_end_noncoding",
+        "seqid": tail["seqid"],
+        "start": tail["end"] + 1,
+        "end": tail["length"],
+        "strand": "+",
+        "order": tail["order"],
+        "part": 1,
+    })
+    chromosome_ends = pd.concat([head, tail]).sort_values(["order", "part"], kind="stable")
+
+    columns = ["key", "seqid", "start", "end", "strand"]
+    return pd.concat([genes[columns], chromosome_ends[columns]], ignore_index=True)
+
+
+def non_coding_intervals(gene_table, lengths):
+    """ Compute intergenic non-coding intervals between consecutive genes sorted by chromosome and end position
+
+    Returns a DataFrame (key, seqid, start, end, strand) in the order extract_non_coding_regions_dict writes them.
+    """
+    # Sort by chromosome (asc) and end position (desc)
+    gene_df_sorted = gene_table.sort_values(["seqid", "end"], ascending=[True, False])
+    gene_df_sorted = gene_df_sorted[gene_df_sorted["seqid"].notna()]
+
+    seqids = gene_df_sorted["seqid"].to_numpy()
+    starts = gene_df_sorted["start"].to_numpy()
+    ends = gene_df_sorted["end"].to_numpy()
+    gene_ids = gene_df_sorted["gene_id"].to_numpy()
+
+    # Compare every gene with the previous one on the same chromosome
+    has_previous = np.zeros(len(seqids), dtype=bool)
+    has_previous[1:] = seqids[1:] == seqids[:-1]
+    previous_starts = np.roll(starts, 1)
+    previous_gene_ids = np.roll(gene_ids, 1)
+
+    # A gap of at least one base lies between this gene's end and the previous gene's start
+    is_gap = has_previous & (previous_starts >= ends + 2)
+    gaps = pd.DataFrame({
+        "seqid": seqids[is_gap],
+        "previous_gene_id": previous_gene_ids[is_gap],
+        "start": ends[is_gap] + 1,
+        "end": previous_starts[is_gap] - 1,
+        "strand": gene_df_sorted["strand"].to_numpy()[is_gap],
+    })
+    gaps = gaps[gaps["seqid"].isin(lengths.index)]
+    count = gaps.groupby("seqid", sort=False).cumcount()
+    gaps.insert(0, "key", (
+        gaps["seqid"].astype(str) + "_" + gaps["previous_gene_id"].astype(str) + "_non_coding_" + count.astype(str)
+    ))
+    return gaps[["key", "seqid", "start", "end", "strand"]].reset_index(drop=True)
+
+
+def unique_keys(intervals):
+    """ Keep one interval per key, at the key's first position with its last interval, like a dictionary update """
+    if intervals["key"].is_unique:
+        return intervals.reset_index(drop=True)
+    last_intervals = intervals.drop_duplicates("key", keep="last").set_index("key")
+    first_order = intervals["key"].drop_duplicates(keep="first").to_numpy()
+    return last_intervals.loc[first_order].reset_index()[intervals.columns]
+
+
+def region_intervals(fasta_sequences, gene_table):
+    """ Compute the intervals of all output regions: genes and chromosome ends, then intergenic regions
+
+    Returns a DataFrame (key, seqid, start, end, strand) in the order of {**gene_sequences, **non_coding_regions}.
+    """
+    print(f"Total genes: {len(gene_table)}")
+    lengths = chromosome_lengths(fasta_sequences, gene_table["seqid"])
+    for seqid in sorted(set(gene_table["seqid"].dropna()) - set(lengths.index), key=str):
+        print(f"Warning: Chromosome {seqid} not in reference sequence")
+    intervals = pd.concat([gene_intervals(gene_table, lengths), non_coding_intervals(gene_table, lengths)])
+    return unique_keys(intervals)
+
+
+def iter_interval_sequences(fasta_sequences, intervals):
+    """ Slice the sequence of every interval out of its chromosome, one interval at a time """
+    for seqid, start, end in zip(intervals["seqid"], intervals["start"], intervals["end"]):
+        yield str(fasta_sequences[seqid][start - 1:end])  # GFF files are 1-based, Python is 0-based
+
+
+def slice_intervals(fasta_sequences, intervals):
+    """ Slice the sequence of every interval out of its chromosome and return them as a list """
+    return list(iter_interval_sequences(fasta_sequences, intervals))
+
+
+def intervals_to_dict(intervals, sequence_list):
+    """ Combine intervals and their sliced sequences into {key: {sequence, strand, start, end}} """
+    sequences = {}
+    for key, sequence, start, end, strand in zip(
+            intervals["key"], sequence_list, intervals["start"], intervals["end"], intervals["strand"]):
+        sequences[key] = {
+            "sequence": sequence,
             "strand": strand,
             "start": start,
             "end": end
         }
+    return sequences
+
+
+def sequences_from_intervals(fasta_sequences, intervals):
+    """ Slice the sequence of every interval out of its chromosome and return {key: {sequence, strand, start, end}} """
+    return intervals_to_dict(intervals, slice_intervals(fasta_sequences, intervals))
+
+
+def _slice_chromosome_shard(args):
+    """ Worker: open the indexed FASTA file and slice the intervals of a single chromosome """
+    fasta_file, shard = args
+    fasta_index = FastaIndex(fasta_file)
+    try:
+        return slice_intervals(fasta_index, shard)
+    finally:
+        fasta_index.close()
+
+
+def interval_shards(intervals, shard_bases=SHARD_BASES):
+    """ Cut the intervals into runs of consecutive intervals on one chromosome, each holding about shard_bases bases """
+    seqids = intervals["seqid"].to_numpy()
+    lengths = (intervals["end"] - intervals["start"] + 1).clip(lower=0).to_numpy()
+    shards = []
+    begin = 0
+    bases = 0
+    for position in range(len(intervals)):
+        if position > begin and (seqids[position] != seqids[begin] or bases >= shard_bases):
+            shards.append(intervals.iloc[begin:position])
+            begin = position
+            bases = 0
+        bases += lengths[position]
+    if begin < len(intervals):
+        shards.append(intervals.iloc[begin:])
+    return shards
+
+
+def iter_interval_sequences_parallel(fasta_file, intervals, num_workers, shard_bases=SHARD_BASES):
+    """ Slice intervals in a process pool and yield their sequences in interval order, like iter_interval_sequences
+
+    Shards are handed out in interval order and yielded as soon as every earlier shard has been, with at most
+    2 * num_workers shards in flight, so memory does not grow with the genome while a slow shard holds up the rest.
+    """
+    shards = interval_shards(intervals, shard_bases)
+    with Pool(min(num_workers, max(len(shards), 1))) as pool:
+        in_flight = deque()
+        for shard in shards:
+            in_flight.append(pool.apply_async(_slice_chromosome_shard, ((fasta_file, shard),)))
+            if len(in_flight) >= 2 * num_workers:
+                yield from in_flight.popleft().get()
+        while in_flight:
+            yield from in_flight.popleft().get()
+
+
+def sequences_from_intervals_parallel(fasta_file, intervals, num_workers):
+    """ Slice intervals in a process pool and return {key: {sequence, strand, start, end}} in interval order """
+    return intervals_to_dict(intervals, list(iter_interval_sequences_parallel(fasta_file, intervals, num_workers)))
+
+
+def extract_all_sequences_parallel(fasta_file, gff_genes, num_workers):
+    """ Extract gene and non-coding sequences of every chromosome in parallel, same output as the serial functions """
+    intervals = region_intervals(FastaIndex(fasta_file), genes_to_table(gff_genes))
+    all_sequences = sequences_from_intervals_parallel(fasta_file, intervals, num_workers)
+    print(f"Total sequences: {len(all_sequences)}")
+    return all_sequences
+
+
+def extract_gene_sequences(fasta_sequences, gff_genes):
+    """ Extract DNA sequences of genes from the FASTA file based on location info, handling overlapping genes """
+    gene_table = genes_to_table(gff_genes)
+    lengths = chromosome_lengths(fasta_sequences, gene_table["seqid"])
+    return sequences_from_intervals(fasta_sequences, gene_intervals(gene_table, lengths))
 
-        # Record the start and end positions of the chromosome boundaries
-        if seqid not in chromosome_boundaries:
-            chromosome_boundaries[seqid] = {"start": start, "end": end}
-        else:
-            chromosome_boundaries[seqid]["start"] = min(chromosome_boundaries[seqid]["start"], start)
-            chromosome_boundaries[seqid]["end"] = max(chromosome_boundaries[seqid]["end"], end)
-
-    # Extract non-coding regions at the beginning and end of the chromosome
-    for seqid, boundaries in chromosome_boundaries.items():
-        chromosome_seq = fasta_sequences[seqid]
-        # Beginning part
-        if boundaries["start"] > 1:
-            start_noncoding_seq = chromosome_seq[:boundaries["start"] - 1]
-            gene_sequences[f"{seqid}_start_noncoding"] = {
-                "sequence": str(start_noncoding_seq),
-                "strand": "+",
-                "start": 1,
-                "end": boundaries["start"] - 1
-            }
-        # Ending part
-        if boundaries["end"] < len(chromosome_seq):
-            end_noncoding_seq = chromosome_seq[boundaries["end"]:]
-            gene_sequences[f"{seqid}_end_noncoding"] = {
-                "sequence": str(end_noncoding_seq),
-                "strand": "+",
-                "start": boundaries["end"] + 1,
-                "end": len(chromosome_seq)
-            }
-
-    return gene_sequences
 
 def extract_non_coding_regions_dict(fasta_sequences, gff_genes):
     """ Extract non-coding region sequences and store them in a dictionary """
-    non_coding_dict = {}
-    data = []
-    for gene_id, info in gff_genes.items():
-        data.append({
-            "gene_id": gene_id,
-            "seqid": info["seqid"],
-            "start": info["start"],
-            "end": info["end"],
-            "strand": info["strand"]
-        })
+    gene_table = genes_to_table(gff_genes)
+    print(f"Total genes: {len(gene_table)}")
 
-    # Create DataFrame and sort by chromosome (asc) and end position (desc)
-    gene_df = pd.DataFrame(data)
-    gene_df_sorted = gene_df.sort_values(['seqid', 'end'], ascending=[True, False])
-
-    print("Sorted gene data:")
-    print(gene_df_sorted.head())
-    print(f"Total genes: {len(gene_df_sorted)}")
-
-    for seqid, group in gene_df_sorted.groupby("seqid"):  # Group by chromosome
-        if seqid not in fasta_sequences:
-            print(f"Warning: Chromosome {seqid} not in reference sequence")
-            continue
-
-        chromosome_seq = fasta_sequences[seqid]
-        previous_start = None  # Record the start position of the previous gene
-        previous_gene_id = None  # Record the name of the previous gene
-
-        # Reset counter
-        non_coding_count = 0
-
-        for _, row in group.iterrows():
-            start, end = row["start"], row["end"]
-            gene_id = row["gene_id"]
-            strand = row["strand"]
-
-            # Skip on the first iteration
-            if previous_start is None:
-                previous_start = start
-                previous_gene_id = gene_id
-                continue
-
-            # Check for non-coding region
-            if previous_start > end:
-                non_coding_start = end + 1
-                non_coding_end = previous_start - 1
-
-                # Extra check for non-coding region length
-                if non_coding_end >= non_coding_start:
-                    try:
-                        non_coding_seq = chromosome_seq[non_coding_start - 1:non_coding_end]
-
-                        # Construct key name: Chromosome + Previous Gene Name + Non-coding Count + "_non_coding"
-                        key = f"{seqid}_{previous_gene_id}_non_coding_{non_coding_count}"
-                        non_coding_dict[key] = {
-                            "sequence": str(non_coding_seq),
-                            "strand": strand,
-                            "start": non_coding_start,
-                            "end": non_coding_end
-                        }
-
-                        # Print non-coding region information
-                        print(f"Non-coding region: {key}")
-                        print(f"  Length: {len(non_coding_seq)}")
-                        print(f"  Start: {non_coding_start}")
-                        print(f"  End: {non_coding_end}")
-
-                        non_coding_count += 1
-                    except IndexError:
-                        print(f"Warning: Error extracting non-coding region {seqid}: {non_coding_start} - {non_coding_end}")
-
-            # Update the start position and gene name for the next iteration
-            previous_start = start
-            previous_gene_id = gene_id
+    lengths = chromosome_lengths(fasta_sequences, gene_table["seqid"])
+    for seqid in sorted(set(gene_table["seqid"].dropna()) - set(lengths.index), key=str):
+        print(f"Warning: Chromosome {seqid} not in reference sequence")
 
+    non_coding_dict = sequences_from_intervals(fasta_sequences, non_coding_intervals(gene_table, lengths))
     print(f"Total non-coding regions: {len(non_coding_dict)}")
     return non_coding_dict
 
@@ -207,24 +439,90 @@ def save_to_csv(gene_sequences, output_file):
     df.to_csv(output_file, index=False)
 
 
+def save_sequences(gene_sequences, output_file, output_format):
+    """ Save the sequences either as a CSV file or as a binary sequence store next to it """
+    if output_format == "csv":
+        save_to_csv(gene_sequences, output_file)
+    else:
+        # "2bit" or "bytes": ./hg19_gene_annotation.csv -> ./hg19_gene_annotation.{json,seq,meta.csv,mask.npy}
+        prefix = os.path.splitext(output_file)[0]
+        write_sequence_store(gene_sequences, prefix, packing=output_format)
+        print(f"Sequence store saved with prefix {prefix}")
+
+
+def _append_csv_rows(f, intervals, begin, sequences):
+    """ Append the CSV rows of intervals[begin:begin + len(sequences)], with the header before the first row """
+    rows = intervals.iloc[begin:begin + len(sequences)]
+    pd.DataFrame({
+        "Gene_ID": rows["key"].to_numpy(),
+        "DNA_Sequence": sequences,
+        "Strand": rows["strand"].to_numpy(),
+        "Start": rows["start"].to_numpy(),
+        "End": rows["end"].to_numpy()
+    }).to_csv(f, header=begin == 0, index=False)
+
+
+def save_interval_sequences(intervals, sequences, output_file, output_format, buffer_bases=WRITE_BUFFER_BASES):
+    """ Stream the sequences of the intervals (an iterable in interval order) to a CSV file or a sequence store
+
+    Rows are written as the sequences arrive, so at most buffer_bases bases (or one larger region) are held
+    in memory. The output is the same as save_sequences on the dictionary of all sequences.
+    """
+    if output_format != "csv":
+        prefix = os.path.splitext(output_file)[0]
+        rows = zip(intervals["key"], sequences, intervals["strand"], intervals["start"], intervals["end"])
+        write_sequence_store_rows(rows, prefix, packing=output_format)
+        print(f"Sequence store saved with prefix {prefix}")
+        return
+    if len(intervals) == 0:
+        save_to_csv({}, output_file)
+        return
+
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        begin = 0
+        buffered = []
+        buffered_bases = 0
+        for sequence in sequences:
+            buffered.append(sequence)
+            buffered_bases += len(sequence)
+            if buffered_bases >= buffer_bases:
+                _append_csv_rows(f, intervals, begin, buffered)
+                begin += len(buffered)
+                buffered = []
+                buffered_bases = 0
+        if buffered:
+            _append_csv_rows(f, intervals, begin, buffered)
+
+
 # Main program
 def main():
     fasta_file = r"./hg19.fa"
     csv_file = r"./hg19_zhengfu_sorted_output_file_end.csv"
     output_file = r"./hg19_gene_annotation.csv"
+    # Read chromosome slices from disk through a .fai index instead of loading the whole genome
+    use_fasta_index = True
+    # Number of processes extracting chromosomes in parallel (requires use_fasta_index), 1 runs serially
+    num_workers = 1
+    # "csv", or a binary sequence store that step 2 can memory-map: "2bit" (packed, ~4x smaller) or "bytes"
+    output_format = "csv"
 
     # Parse FASTA and CSV files
-    fasta_sequences = parse_fasta(fasta_file)
-    gff_genes = parse_csv(csv_file)
+    if use_fasta_index:
+        fasta_sequences = parse_fasta_indexed(fasta_file)
+    else:
+        fasta_sequences = parse_fasta(fasta_file)
+    gff_genes = parse_csv_table(csv_file)
     print(gff_genes)
 
-    # Extract gene sequences and non-coding regions
-    gene_sequences = extract_gene_sequences(fasta_sequences, gff_genes)
-    non_coding_regions = extract_non_coding_regions_dict(fasta_sequences, gff_genes)
-
-    # Save results to a CSV file
-    all_sequences = {**gene_sequences, **non_coding_regions}
-    save_to_csv(all_sequences, output_file)
+    # Locate gene sequences and non-coding regions, then slice and write them one region at a time,
+    # so with the .fai index only the regions being written are in memory
+    intervals = region_intervals(fasta_sequences, gff_genes)
+    if use_fasta_index and num_workers > 1:
+        sequences = iter_interval_sequences_parallel(fasta_file, intervals, num_workers)
+    else:
+        sequences = iter_interval_sequences(fasta_sequences, intervals)
+    save_interval_sequences(intervals, sequences, output_file, output_format)
+    print(f"Total sequences: {len(intervals)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+import json
+import os
+
+# A store is a set of files sharing a prefix P (see sequence_store.py and token_store.py), described by the
+# JSON header P.json: {"format": store format, "version": format version, ...format-specific fields}
+
+
+def store_prefix(path):
+    """ Return the prefix of a store given either the prefix or its header file """
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return path
+
+
+def header_path(prefix):
+    """ Return the header path of the store with this prefix """
+    return prefix + ".json"
+
+
+def is_store(path, store_format):
+    """ Check whether path is the prefix (or header file) of a complete store of the given format """
+    path = header_path(store_prefix(path))
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as f:
+        header = json.load(f)
+    # Headers written before the format field existed are accepted for either format
+    return header.get("format", store_format) == store_format
+
+
+def write_header(prefix, store_format, version, **fields):
+    """ Write the header of a store. Call it after every other file of the store has been written:
+    the header is what marks a store complete, so an interrupted write is never mistaken for one """
+    path = header_path(prefix)
+    with open(path + ".tmp", 'w') as f:
+        json.dump({"format": store_format, "version": version, **fields}, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_header(prefix, store_format, version):
+    """ Read the header of a store, raising ValueError if it is of another format or version """
+    path = header_path(prefix)
+    with open(path, 'r') as f:
+        header = json.load(f)
+    if header.get("format", store_format) != store_format:
+        raise ValueError(f"{path} is the header of a {header['format']}, not of a {store_format}")
+    if header["version"] != version:
+        raise ValueError(f"Unsupported {store_format} version {header['version']} in {path}")
+    return header
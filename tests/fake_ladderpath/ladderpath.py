@@ -0,0 +1,20 @@
+"""
+Stand-in for the ladderpath package in tests: every sequence becomes a token of multiplicity 1,
+and a batch whose first sequence starts with "KILL" kills its worker, as the OOM killer would.
+"""
+import os
+import signal
+
+
+def get_ladderpath(sequences, save_file_name=None, show_version=False, **params):
+    if sequences[0].startswith("KILL"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    return {"sequences": list(sequences)}
+
+
+def disp3index(lpjson):
+    return len(lpjson["sequences"]), 0, 0
+
+
+def POM_from_JSON(lpjson, display_str=False):
+    return {"0": {sequence: 1 for sequence in lpjson["sequences"]}}, ""
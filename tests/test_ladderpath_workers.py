@@ -0,0 +1,55 @@
+import os
+import signal
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "fake_ladderpath"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Ladderpath_multiprocess_DNASequence import AdmissionController, load_manifest, run_batches
+
+
+@pytest.fixture(autouse=True)
+def timeout():
+    """ Turn a hanging run_batches into a test failure """
+    def fail(signum, frame):
+        raise TimeoutError("run_batches did not finish")
+    previous = signal.signal(signal.SIGALRM, fail)
+    signal.alarm(60)
+    yield
+    signal.alarm(0)
+    signal.signal(signal.SIGALRM, previous)
+
+
+def make_batches(num_batches, killed):
+    return [["KILL"] if batch_index in killed else [f"ACGT{batch_index}"] for batch_index in range(1, num_batches + 1)]
+
+
+@pytest.mark.parametrize("use_admission", [False, True])
+def test_worker_killed_mid_batch(tmp_path, capsys, use_admission):
+    output_folder = str(tmp_path)
+    manifest_path = os.path.join(output_folder, "manifest.jsonl")
+    admission = AdmissionController(1 << 40, 0, 4, 1, 100) if use_admission else None
+
+    with pytest.raises(RuntimeError, match="2 of 12 batches are missing"):
+        run_batches(iter(make_batches(12, {1, 2})), output_folder, 2, 4, manifest_path, admission=admission)
+
+    assert "batches got no result because their worker died: [1, 2]" in capsys.readouterr().out
+    pom_files = sorted(name for name in os.listdir(output_folder) if name.endswith(".pom"))
+    assert pom_files == sorted(f"pom_data_batch_{batch_index}.pom" for batch_index in range(3, 13))
+    manifest = load_manifest(manifest_path)
+    assert [manifest[batch_index]["status"] for batch_index in (1, 2)] == ["failed", "failed"]
+    assert all(manifest[batch_index]["status"] == "done" for batch_index in range(3, 13))
+
+
+def test_rerun_computes_only_lost_batches(tmp_path, capsys):
+    output_folder = str(tmp_path)
+    manifest_path = os.path.join(output_folder, "manifest.jsonl")
+    with pytest.raises(RuntimeError):
+        run_batches(iter(make_batches(6, {2})), output_folder, 2, 4, manifest_path)
+    capsys.readouterr()
+
+    assert run_batches(iter(make_batches(6, set())), output_folder, 2, 4, manifest_path) == 6
+    assert "Skipped 5 batches" in capsys.readouterr().out
+    assert load_manifest(manifest_path)[2]["status"] == "done"
@@ -0,0 +1,133 @@
+import argparse
+import os
+import numpy as np
+from store_format import header_path, is_store, read_header, store_prefix, write_header
+
+# Files making up a token store with prefix P:
+#   P.json         header (format, version, token dtype, number of sequences and tokens), see store_format.py
+#   P.tokens       token IDs of all sequences, concatenated into one flat array
+#   P.offsets.npy  num_sequences + 1 int64 offsets into P.tokens, sequence i is tokens[offsets[i]:offsets[i + 1]]
+STORE_FORMAT = "token store"
+STORE_VERSION = 1
+
+
+def store_paths(prefix):
+    """ Return the header, token and offset paths of a token store """
+    return header_path(prefix), prefix + ".tokens", prefix + ".offsets.npy"
+
+
+def is_token_store(path):
+    """ Check whether path is the prefix (or header file) of a token store """
+    return is_store(path, STORE_FORMAT)
+
+
+def token_dtype(max_token_id):
+    """ Smallest signed integer type holding every token ID """
+    return np.int16 if max_token_id <= np.iinfo(np.int16).max else np.int32
+
+
+def write_token_store(sequences, prefix, chunk_tokens=1 << 22):
+    """ Save an iterable of token ID sequences as a flat token array plus an offsets array.
+
+    Tokens are buffered as int32 and written in chunks; once every ID is known, the array is narrowed to
+    int16 in place when the vocabulary allows it, halving the file. """
+    _, tokens_path, offsets_path = store_paths(prefix)
+
+    offsets = [0]
+    buffer = []
+    buffered = 0
+    max_token_id = 0
+    with open(tokens_path, 'wb') as f:
+        for sequence in sequences:
+            ids = np.asarray(sequence, dtype=np.int32)
+            if len(ids):
+                max_token_id = max(max_token_id, int(ids.max()))
+            buffer.append(ids)
+            buffered += len(ids)
+            offsets.append(offsets[-1] + len(ids))
+            if buffered >= chunk_tokens:
+                np.concatenate(buffer).tofile(f)
+                buffer, buffered = [], 0
+        if buffer:
+            np.concatenate(buffer).tofile(f)
+
+    num_tokens = offsets[-1]
+    dtype = token_dtype(max_token_id)
+    if dtype != np.int32 and num_tokens > 0:
+        wide = np.memmap(tokens_path, dtype=np.int32, mode='r+')
+        narrow = wide.view(dtype)
+        # Narrowing front to back never overwrites an int32 value that has not been read yet
+        for start in range(0, num_tokens, chunk_tokens):
+            end = min(start + chunk_tokens, num_tokens)
+            narrow[start:end] = wide[start:end]
+        narrow.flush()
+        del wide, narrow
+        with open(tokens_path, 'r+b') as f:
+            f.truncate(num_tokens * np.dtype(dtype).itemsize)
+
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+    write_header(
+        prefix, STORE_FORMAT, STORE_VERSION,
+        dtype=np.dtype(dtype).name, num_sequences=len(offsets) - 1, num_tokens=num_tokens
+    )
+
+
+def iter_text_file(file_path):
+    """ Stream the token ID lines of a text training file (space-separated IDs, one sequence per line) """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            ids = line.split()
+            if ids:
+                yield list(map(int, ids))
+
+
+def convert_text_file(file_path, prefix):
+    """ One-time conversion of a text training file into a token store """
+    write_token_store(iter_text_file(file_path), prefix)
+
+
+class TokenStore:
+    """ Read-only, memory-mapped view of a token store written by write_token_store """
+
+    def __init__(self, prefix):
+        prefix = store_prefix(prefix)
+        _, tokens_path, offsets_path = store_paths(prefix)
+        header = read_header(prefix, STORE_FORMAT, STORE_VERSION)
+        self.dtype = np.dtype(header["dtype"])
+        self.offsets = np.load(offsets_path)
+        # Copy-on-write mapping: pages are shared between processes, and the arrays stay writable for torch
+        if header["num_tokens"] > 0:
+            self.tokens = np.memmap(tokens_path, dtype=self.dtype, mode='c', shape=(header["num_tokens"],))
+        else:
+            self.tokens = np.empty(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, i):
+        """ Zero-copy view of the token IDs of sequence i """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a text training file (space-separated token IDs per line) into a token store."
+    )
+    parser.add_argument("--input", required=True, type=str, help="Text file written by tokenize_sequences.py.")
+    parser.add_argument(
+        "--output", default=None, type=str,
+        help="Prefix of the token store, by default the input path without its extension."
+    )
+    args = parser.parse_args()
+
+    prefix = args.output or os.path.splitext(args.input)[0]
+    convert_text_file(args.input, prefix)
+    store = TokenStore(prefix)
+    print(f"Token store written to {prefix}: {len(store)} sequences, {len(store.tokens)} tokens ({store.dtype.name})")
+
+
+if __name__ == "__main__":
+    main()
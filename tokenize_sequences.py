@@ -0,0 +1,318 @@
+import argparse
+import re
+import time
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from sequence_store import SequenceStore, is_sequence_store
+
+# Vocabulary lines such as [PAD], [UNK], [CLS], [SEP], [MASK] are special tokens, never matched against sequences
+special_token_pattern = re.compile(r"^\[[^\]]+\]$")
+dna_token_pattern = re.compile(r"^[ACGT]+$")
+
+_BASE_CODES = np.zeros(256, dtype=np.uint32)
+_INVALID = np.ones(256, dtype=bool)
+for _code, _letter in enumerate(b"ACGT"):
+    _BASE_CODES[_letter] = _code
+    _INVALID[_letter] = False
+_DIGITS = str.maketrans("ACGT", "0123")
+
+# Per-process tokenizer state, set by init_worker
+_tokenizer = None
+
+
+def load_vocab(vocab_file):
+    """ Read vocab.txt into {token: token ID}, the ID being the line number as in BertTokenizer """
+    vocab = {}
+    with open(vocab_file, 'r', encoding='utf-8') as f:
+        for index, line in enumerate(f):
+            token = line.rstrip('\n')
+            if token and token not in vocab:
+                vocab[token] = index
+    return vocab
+
+
+def greedy_walk(steps):
+    """ Positions visited by the walk i -> i + steps[i] from 0 (every step >= 1).
+
+    Long arrays are split into blocks of about 2 * sqrt(n) positions and one walker per block is advanced
+    in lockstep with numpy. Greedy segmentations resynchronize within a few tokens, so the true walk,
+    stitched block by block, quickly lands on the path of each block's walker and follows it from there. """
+    length = len(steps)
+    block = max(64, 2 * int(np.sqrt(length)))
+    starts = np.arange(0, length, block)
+    ends = np.minimum(starts + block, length)
+
+    rows = []
+    walkers = starts.copy()
+    active = np.ones(len(starts), dtype=bool)
+    while active.any():
+        rows.append(np.where(active, walkers, -1))
+        walkers[active] += steps[walkers[active]]
+        active &= walkers < ends
+    paths = np.stack(rows, axis=1)
+
+    # Step of each visited position within its walker's path
+    path_index = np.full(length, -1, dtype=np.int64)
+    walker_ids, path_steps = np.nonzero(paths >= 0)
+    path_index[paths[walker_ids, path_steps]] = path_steps
+
+    pieces = []
+    position = 0
+    for b in range(len(starts)):
+        end = ends[b]
+        if position >= end:
+            continue
+        detour = []
+        while position < end and path_index[position] < 0:
+            detour.append(position)
+            position += steps[position]
+        if detour:
+            pieces.append(np.array(detour, dtype=np.int64))
+        if position < end:
+            path = paths[b, path_index[position]:]
+            pieces.append(path[path >= 0])
+            position = walkers[b]
+    return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.int64)
+
+
+def kmer_code(kmer):
+    """ 2-bit integer code of a k-mer (A=0 C=1 G=2 T=3, first base in the high bits) """
+    return int(kmer.translate(_DIGITS), 4)
+
+
+class GreedyTokenizer:
+    """ Greedy longest-match segmentation of DNA sequences over the Ladderpath tokens of vocab.txt.
+
+    The trie of the vocabulary is flattened into a lookup table over all 4**table_k k-mers: entry x holds
+    the longest token that is a prefix of x. The k-mer code of every position of a fragment is computed
+    with numpy, and the greedy walk over the resulting jumps is vectorized by greedy_walk. Positions where a token longer than
+    table_k may start, or whose k-mer runs past the end of the ACGT run, fall back to dictionary lookups.
+
+    Positions not covered by any vocabulary token fall back to unk_token: a run of non-ACGT characters
+    becomes a single unk_token, and so does a lone base missing from the vocabulary. """
+
+    def __init__(self, vocab, unk_token="[UNK]", cls_token=None, sep_token=None, block_size=512, table_k=11):
+        if unk_token not in vocab:
+            raise ValueError(
+                f"{unk_token} is not in the vocabulary, build vocab.txt with bulid_vocab.py without --no-special-tokens"
+            )
+        self.unk_id = str(vocab[unk_token])
+        self.prefix = f"{vocab[cls_token]} " if cls_token else ""
+        self.suffix = f" {vocab[sep_token]}" if sep_token else ""
+        self.max_tokens = block_size - bool(cls_token) - bool(sep_token)
+        if self.max_tokens <= 0:
+            raise ValueError(f"block_size {block_size} leaves no room for sequence tokens")
+
+        # Table entry 0 is the out-of-vocabulary fallback, entry j the j-th DNA token of the vocabulary
+        tokens = [token for token in vocab if dna_token_pattern.match(token)]
+        self.token_strings = np.array([self.unk_id] + [str(vocab[token]) for token in tokens], dtype=object)
+        self.token_index = {token: j for j, token in enumerate(tokens, start=1)}
+        self.lengths = sorted({len(token) for token in tokens}, reverse=True)
+
+        k = max(1, min(table_k, self.lengths[0] if tokens else 1))
+        self.table_k = k
+        self.table_index = np.zeros(4 ** k, dtype=np.int32)
+        self.table_length = np.ones(4 ** k, dtype=np.int8)
+        # Shorter tokens first, so every k-mer ends up with the longest token it starts with
+        for token in sorted(tokens, key=len):
+            if len(token) <= k:
+                shift = 2 * (k - len(token))
+                code = kmer_code(token)
+                self.table_index[code << shift:(code + 1) << shift] = self.token_index[token]
+                self.table_length[code << shift:(code + 1) << shift] = len(token)
+        for token in tokens:
+            if len(token) > k:
+                self.table_length[kmer_code(token[:k])] = 0
+
+    def match(self, sequence, i):
+        """ Longest vocabulary token at position i, as (table entry, length); entry 0 is the fallback """
+        remaining = len(sequence) - i
+        for length in self.lengths:
+            if length <= remaining:
+                j = self.token_index.get(sequence[i:i + length])
+                if j:
+                    return j, length
+        return 0, 1
+
+    def encode(self, sequence, stats):
+        """ Token ID strings of a sequence, updating stats [bases, tokens, oov_tokens, oov_bases, lines] """
+        sequence = sequence.upper()
+        length = len(sequence)
+        if length == 0:
+            return []
+        k = self.table_k
+        raw = np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)
+        codes = _BASE_CODES[raw]
+        invalid = _INVALID[raw]
+
+        # Table lookup at every position whose k-mer lies inside a run of ACGT, a step of 0 marks the
+        # positions left to match() (possible long tokens, k-mers reaching past the end or over a non-ACGT base)
+        steps = np.zeros(length, dtype=np.int64)
+        entries = np.zeros(length, dtype=np.int64)
+        num_kmers = length - k + 1
+        if num_kmers > 0:
+            kmers = np.zeros(num_kmers, dtype=np.uint32)
+            for j in range(k):
+                kmers <<= 2
+                kmers |= codes[j:j + num_kmers]
+            steps[:num_kmers] = self.table_length[kmers]
+            entries[:num_kmers] = self.table_index[kmers]
+            invalid_count = np.concatenate(([0], np.cumsum(invalid)))
+            steps[:num_kmers][invalid_count[k:] != invalid_count[:num_kmers]] = 0
+
+        # A run of non-ACGT characters is skipped as a single fallback token, from any position inside it
+        edges = np.diff(np.concatenate(([0], invalid.view(np.int8), [0])))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+        steps[invalid] = np.repeat(run_ends, run_ends - run_starts) - np.flatnonzero(invalid)
+        entries[invalid] = 0
+
+        for i in np.flatnonzero(steps == 0).tolist():
+            entries[i], steps[i] = self.match(sequence, i)
+
+        positions = greedy_walk(steps)
+        token_entries = entries[positions]
+        oov = token_entries == 0
+        stats[0] += length
+        stats[1] += len(positions)
+        stats[2] += int(oov.sum())
+        stats[3] += int(steps[positions][oov].sum())
+        return self.token_strings[token_entries].tolist()
+
+    def encode_lines(self, sequence, stats):
+        """ Encode a sequence into lines of at most block_size space-separated token IDs """
+        ids = self.encode(sequence, stats)
+        lines = [
+            self.prefix + ' '.join(ids[start:start + self.max_tokens]) + self.suffix
+            for start in range(0, len(ids), self.max_tokens)
+        ]
+        stats[4] += len(lines)
+        return lines
+
+
+def init_worker(vocab, unk_token, cls_token, sep_token, block_size, table_k):
+    global _tokenizer
+    _tokenizer = GreedyTokenizer(vocab, unk_token, cls_token, sep_token, block_size, table_k)
+
+
+def tokenize_chunk(sequences):
+    """ Worker task: encode a chunk of sequences, returning the output text and its statistics """
+    stats = [0, 0, 0, 0, 0]
+    lines = []
+    for sequence in sequences:
+        lines.extend(_tokenizer.encode_lines(sequence, stats))
+    return ''.join(line + '\n' for line in lines), stats
+
+
+def iter_sequences(file_path, chunk_rows=10000):
+    """ Stream the step-1 sequences from the CSV file (in chunks of rows) or from a sequence store """
+    if is_sequence_store(file_path):
+        yield from SequenceStore(file_path)
+        return
+    for frame in pd.read_csv(file_path, usecols=['DNA_Sequence'], dtype=str, keep_default_na=False,
+                             chunksize=chunk_rows):
+        yield from frame['DNA_Sequence']
+
+
+def chunk_sequences(sequences, chunk_bases):
+    """ Group sequences into chunks of about chunk_bases bases, one worker task each. Sequences are never
+    split, so the segmentation does not depend on the chunking. """
+    chunk = []
+    length = 0
+    for sequence in sequences:
+        if not sequence:
+            continue
+        chunk.append(sequence)
+        length += len(sequence)
+        if length >= chunk_bases:
+            yield chunk
+            chunk = []
+            length = 0
+    if chunk:
+        yield chunk
+
+
+def iter_results(chunks, num_workers, initargs):
+    """ Tokenize the chunks in order. With several workers, at most 2 * num_workers chunks are in flight,
+    so the input is streamed instead of being queued in full by the pool. """
+    if num_workers <= 1:
+        init_worker(*initargs)
+        for chunk in chunks:
+            yield tokenize_chunk(chunk)
+        return
+    with Pool(num_workers, initializer=init_worker, initargs=initargs) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(tokenize_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def report(stats, elapsed, prefix=""):
+    bases, tokens, oov_tokens, oov_bases, lines = stats
+    elapsed = max(elapsed, 1e-9)
+    print(f"{prefix}{bases / 1e6:.1f} Mbp -> {tokens} tokens in {lines} lines, {elapsed:.1f} s "
+          f"({bases / elapsed / 1e6:.1f} Mbp/s, {tokens / elapsed / 1e6:.2f} M tokens/s); "
+          f"OOV fallback: {oov_tokens / max(tokens, 1):.3%} of tokens, {oov_bases / max(bases, 1):.3%} of bases")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the step-1 sequences into space-separated token ID lines for LPT_pretrain.py."
+    )
+    parser.add_argument(
+        "--input", default="./hg19_gene_annotation.csv", type=str,
+        help="Sequences written by split_chrom.py: the CSV file or a sequence store prefix."
+    )
+    parser.add_argument("--vocab", default="./vocab.txt", type=str, help="Vocabulary, one token per line.")
+    parser.add_argument("--output", default="./tokenized_data.txt", type=str, help="Tokenized training data.")
+    parser.add_argument(
+        "--block_size", default=512, type=int,
+        help="Maximum number of token IDs per line, special tokens included. Longer sequences span several lines."
+    )
+    parser.add_argument(
+        "--add_special_tokens", action="store_true",
+        help="Wrap every line in --cls_token and --sep_token."
+    )
+    parser.add_argument("--unk_token", default="[UNK]", type=str, help="Token used for out-of-vocabulary positions.")
+    parser.add_argument("--cls_token", default="[CLS]", type=str)
+    parser.add_argument("--sep_token", default="[SEP]", type=str)
+    parser.add_argument(
+        "--table_k", default=11, type=int,
+        help="k of the k-mer lookup table (4**k entries per process), longer tokens are matched with dictionary lookups."
+    )
+    parser.add_argument("--num_workers", default=1, type=int, help="Number of tokenizer processes.")
+    parser.add_argument(
+        "--chunk_bases", default=4000000, type=int,
+        help="Approximate number of bases per worker task."
+    )
+    parser.add_argument("--log_interval", default=100, type=int, help="Report progress every N chunks.")
+    args = parser.parse_args()
+
+    vocab = load_vocab(args.vocab)
+    cls_token, sep_token = (args.cls_token, args.sep_token) if args.add_special_tokens else (None, None)
+    for token in (cls_token, sep_token):
+        if token is not None and token not in vocab:
+            raise ValueError(f"{token} is not in the vocabulary {args.vocab}")
+    initargs = (vocab, args.unk_token, cls_token, sep_token, args.block_size, args.table_k)
+
+    start_time = time.time()
+    totals = [0, 0, 0, 0, 0]
+    chunks = chunk_sequences(iter_sequences(args.input), args.chunk_bases)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for index, (text, stats) in enumerate(iter_results(chunks, args.num_workers, initargs), start=1):
+            f.write(text)
+            totals = [total + value for total, value in zip(totals, stats)]
+            if args.log_interval > 0 and index % args.log_interval == 0:
+                report(totals, time.time() - start_time, prefix=f"[{index} chunks] ")
+
+    report(totals, time.time() - start_time, prefix="Finished: ")
+    print(f"Tokenized data written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()